@@ -0,0 +1,72 @@
+import argparse
+import struct
+import timeit
+
+import miramode
+
+
+def _legacy_crc(data):
+    i = 0
+    i2 = 0xFFFF
+    while i < len(data):
+        b = data[i]
+        i3 = i2
+        for i2 in range(8):
+            i4 = 1
+            i5 = 1 if ((b >> (7 - i2)) & 1) == 1 else 0
+            if ((i3 >> 15) & 1) != 1:
+                i4 = 0
+            i3 = i3 << 1
+            if (i5 ^ i4) != 0:
+                i3 = i3 ^ 0x1021
+        i += 1
+        i2 = i3
+    return i2 & 0xFFFF
+
+
+def _legacy_payload_with_crc(payload, client_id):
+    crc = _legacy_crc(payload + struct.pack(">I", client_id))
+    return payload + struct.pack(">H", crc)
+
+
+def _report(name, number, seconds):
+    print(f"{name:<28} {number / seconds:>14,.0f} ops/s "
+          f"{seconds / number * 1e6:>10.3f} us/op")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--number", type=int, default=100000,
+        help="Number of iterations per benchmark")
+    args = parser.parse_args()
+
+    client_id = 12345
+    state_payload = bytearray([1, 0x7, 0])
+    pair_payload = bytearray([0, 0xeb, 24]) + bytearray(range(28))
+
+    for payload in (state_payload, pair_payload):
+        assert (_legacy_payload_with_crc(payload, client_id) ==
+                miramode._get_payload_with_crc(payload, client_id))
+
+    conn = miramode.Connnection(None, client_id, 1)
+
+    benchmarks = [
+        ("legacy crc (7 bytes)",
+         lambda: _legacy_payload_with_crc(state_payload, client_id)),
+        ("table crc (7 bytes)",
+         lambda: miramode._get_payload_with_crc(state_payload, client_id)),
+        ("legacy crc (35 bytes)",
+         lambda: _legacy_payload_with_crc(pair_payload, client_id)),
+        ("table crc (35 bytes)",
+         lambda: miramode._get_payload_with_crc(pair_payload, client_id)),
+        ("cached device state frame",
+         lambda: conn._get_frame(0x7)),
+    ]
+
+    for name, func in benchmarks:
+        _report(name, args.number, timeit.timeit(func, number=args.number))
+
+
+if __name__ == '__main__':
+    main()
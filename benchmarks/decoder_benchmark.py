@@ -0,0 +1,103 @@
+import argparse
+import struct
+import timeit
+
+import miramode
+from miramode import decoder
+from miramode import records
+
+PAYLOADS = [
+    bytes([0x01]),
+    bytes([0x00, 0x0b]),
+    bytes([0x00, 0x03, 0x01, 0x02]),
+    bytes([0x01, 0x01, 0x7e, 0x01, 0x77, 0x64, 0x00, 0x00, 0x64, 0x05]),
+    bytes([0x01, 0x01, 0x01, 0x7e, 0x01, 0x77, 0x64, 0x00, 0x00, 0x64,
+           0x05]),
+    bytes([0x04, 0x00, 0x00, 0x00, 0x3c, 0x01, 0xc2, 0x00, 0xfa, 0x00,
+           0x05]),
+    bytes([0x00, 0x01, 0x00, 0x02, 0x00, 0x03, 0x00, 0x04] + [0] * 7 +
+          [0x05]),
+    b"Bathroom".ljust(16, b"\0"),
+    b"Home Assistant".ljust(20, b"\0"),
+    bytes([0x01, 0x01, 0x7e, 0x00, 0x3c, 0x03, 0x00, 0x00]) +
+    b"Morning".ljust(16, b"\0"),
+]
+
+
+def _legacy_decode(client_slot, payload):
+    # The if/elif chain previously used by Connnection._handle_data
+    payload_length = len(payload)
+    if payload_length == 1:
+        return records.SuccessOrFailure(client_slot, payload[0])
+    elif payload_length == 2:
+        slot_bits = struct.unpack(">H", payload)[0]
+        return records.Slots(
+            client_slot, miramode._bits_to_list(slot_bits, 16))
+    elif payload_length == 4:
+        return records.DeviceSettings(
+            client_slot, miramode._bits_to_list(payload[1], 8), payload[2],
+            miramode._bits_to_list(payload[3], 8))
+    elif payload_length == 10:
+        return records.DeviceState(
+            client_slot, payload[0],
+            miramode._convert_temperature_reverse(payload[1:3]),
+            miramode._convert_temperature_reverse(payload[3:5]),
+            payload[5] == miramode.OUTLET_RUNNING,
+            payload[6] == miramode.OUTLET_RUNNING,
+            struct.unpack(">H", payload[7:9])[0], payload[9])
+    elif payload_length == 11 and payload[0] in [1, 0x80]:
+        return records.ControlsOperated(
+            client_slot, payload[0] == 1, payload[1],
+            miramode._convert_temperature_reverse(payload[2:4]),
+            miramode._convert_temperature_reverse(payload[4:6]),
+            payload[6] == miramode.OUTLET_RUNNING,
+            payload[7] == miramode.OUTLET_RUNNING,
+            struct.unpack(">H", payload[8:10])[0], payload[10])
+    elif payload_length == 11 and payload[0] in [0, 0x4, 0x8]:
+        return records.OutletSettings(
+            client_slot, payload[0], payload[4],
+            miramode._convert_temperature_reverse(payload[5:7]),
+            miramode._convert_temperature_reverse(payload[7:9]),
+            payload[10])
+    elif payload_length == 16 and payload[0] == 0:
+        return records.TechnicalInformation(
+            client_slot, payload[1], payload[3], payload[5], payload[7],
+            payload[15])
+    elif payload_length == 16 and payload[0] != 0:
+        return records.Nickname(client_slot, payload.decode('UTF-8'))
+    elif payload_length == 20:
+        return records.ClientDetails(client_slot, payload.decode('UTF-8'))
+    elif payload_length == 24:
+        return records.PresetDetails(
+            client_slot, payload[0],
+            miramode._convert_temperature_reverse(payload[1:3]),
+            payload[4], miramode._bits_to_list(payload[5], 8),
+            payload[8:].decode('UTF-8'))
+
+
+def _decode_all(decode):
+    for payload in PAYLOADS:
+        decode(1, payload)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--number", type=int, default=20000,
+        help="Number of iterations per benchmark")
+    args = parser.parse_args()
+
+    for payload in PAYLOADS:
+        assert _legacy_decode(1, payload) == decoder.decode(1, payload)
+
+    for name, decode in [("legacy if/elif chain", _legacy_decode),
+                         ("table dispatch", decoder.decode)]:
+        seconds = timeit.timeit(
+            lambda: _decode_all(decode), number=args.number)
+        count = args.number * len(PAYLOADS)
+        print(f"{name:<28} {count / seconds:>14,.0f} payloads/s "
+              f"{seconds / count * 1e6:>10.3f} us/payload")
+
+
+if __name__ == '__main__':
+    main()
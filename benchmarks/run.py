@@ -0,0 +1,238 @@
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import miramode
+from miramode import decoder
+from miramode import reassembly
+from miramode import simulator
+
+import decoder_benchmark
+import startup_benchmark
+
+SIMULATED_ADDRESS = "00:00:00:00:00:01"
+CLIENT_ID = 12345
+
+
+def _rate(func, number, repeat):
+    # Best of "repeat" runs, in operations per second
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(number)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return number / best
+
+
+def _metric(value, unit, higher_is_better=True):
+    return {"value": value, "unit": unit,
+            "higher_is_better": higher_is_better}
+
+
+def bench_frames(number, repeat):
+    payload = bytearray([1, miramode.OPCODE_DEVICE_STATE, 0])
+    conn = miramode.Connnection(SIMULATED_ADDRESS, CLIENT_ID, 1)
+
+    def _build(n):
+        for _ in range(n):
+            miramode._get_payload_with_crc(payload, CLIENT_ID)
+
+    def _cached(n):
+        for _ in range(n):
+            conn._get_frame(miramode.OPCODE_DEVICE_STATE)
+
+    return {
+        "frames_built": _metric(_rate(_build, number, repeat), "frames/s"),
+        "frames_cached": _metric(_rate(_cached, number, repeat), "frames/s"),
+    }
+
+
+def bench_decoder(number, repeat):
+    payloads = [memoryview(p) for p in decoder_benchmark.PAYLOADS]
+
+    def _decode(n):
+        for _ in range(n // len(payloads)):
+            for payload in payloads:
+                decoder.decode(1, payload)
+
+    return {
+        "notifications_decoded": _metric(
+            _rate(_decode, number, repeat), "notifications/s"),
+    }
+
+
+def bench_reassembly(number, repeat):
+    packet = (bytes([0x41, miramode.OPCODE_PRESETS, 24]) +
+              decoder_benchmark.PAYLOADS[-1])
+    fragments = [packet[:20], packet[20:]]
+    reassembler = reassembly.Reassembler()
+
+    def _reassemble(n):
+        feed = reassembler.feed
+        for _ in range(n):
+            for fragment in fragments:
+                feed(fragment)
+
+    return {
+        "payloads_reassembled": _metric(
+            _rate(_reassemble, number, repeat), "payloads/s"),
+    }
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percentile / 100))
+    return values[index]
+
+
+def bench_end_to_end(number, repeat):
+    device = simulator.SimulatedMiraDevice(SIMULATED_ADDRESS)
+    client_slot = device.add_client(CLIENT_ID, "Benchmark")
+    for preset_slot in range(8):
+        device.add_preset(preset_slot, f"Preset {preset_slot}")
+    miramode.set_backend(simulator.SimulatedBackend([device]))
+
+    latencies = []
+    with miramode.Connnection(
+            SIMULATED_ADDRESS, CLIENT_ID, client_slot) as conn:
+        for _ in range(number):
+            start = time.perf_counter()
+            conn.request_device_state().result()
+            latencies.append(time.perf_counter() - start)
+
+        def _sequential(n):
+            for _ in range(n):
+                conn.request_device_state().result()
+
+        def _pipelined(n):
+            conn.pipeline([conn.request_device_state] * n, window=8)
+
+        def _presets(n):
+            for _ in range(n):
+                conn.get_presets(window=8)
+
+        return {
+            "command_latency_p50": _metric(
+                _percentile(latencies, 50) * 1e6, "us", False),
+            "command_latency_p95": _metric(
+                _percentile(latencies, 95) * 1e6, "us", False),
+            "commands_sequential": _metric(
+                _rate(_sequential, number, repeat), "commands/s"),
+            "commands_pipelined": _metric(
+                _rate(_pipelined, number, repeat), "commands/s"),
+            "preset_lists": _metric(
+                _rate(_presets, max(1, number // 10), repeat), "lists/s"),
+        }
+
+
+def bench_startup(number, repeat):
+    return {
+        "cli_import_time": _metric(
+            startup_benchmark.best_import_time(
+                "miramode.cli", number * repeat) / 1000, "ms", False),
+    }
+
+
+BENCHMARKS = {
+    "frames": (bench_frames, 100000),
+    "decoder": (bench_decoder, 100000),
+    "reassembly": (bench_reassembly, 100000),
+    "end_to_end": (bench_end_to_end, 1000),
+    "startup": (bench_startup, 5),
+}
+
+
+def _get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(results, baseline, max_regression):
+    regressions = []
+    for name, metric in results.items():
+        base = baseline.get(name)
+        if not base or not base["value"]:
+            continue
+        change = (metric["value"] - base["value"]) / base["value"]
+        if not metric["higher_is_better"]:
+            change = -change
+        status = ""
+        if change < -max_regression:
+            status = "REGRESSION"
+            regressions.append(name)
+        print(f"{name:<28} {base['value']:>14,.1f} -> "
+              f"{metric['value']:>14,.1f} {metric['unit']:<16} "
+              f"{change:>+8.1%} {status}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-o", "--output",
+        help="Save the results to the given JSON file")
+    parser.add_argument(
+        "-c", "--compare",
+        help="A JSON file with previous results to compare with")
+    parser.add_argument(
+        "--max-regression", type=float, default=0.2,
+        help="The relative slowdown after which the comparison fails")
+    parser.add_argument(
+        "-s", "--scale", type=float, default=1.0,
+        help="Scale the number of iterations of each benchmark")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="Number of runs of each benchmark, the best one is kept")
+    parser.add_argument(
+        "benchmarks", nargs="*",
+        help="The benchmarks to run, all if omitted: "
+        f"{', '.join(BENCHMARKS)}")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark: {name}")
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        func, number = BENCHMARKS[name]
+        metrics = func(max(1, int(number * args.scale)), args.repeat)
+        for metric_name, metric in metrics.items():
+            print(f"{metric_name:<28} {metric['value']:>14,.1f} "
+                  f"{metric['unit']}")
+        results.update(metrics)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "metadata": {
+                    "timestamp": datetime.datetime.now(
+                        datetime.timezone.utc).isoformat(),
+                    "commit": _get_git_commit(),
+                    "python": sys.version,
+                    "platform": platform.platform(),
+                },
+                "results": results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        print()
+        regressions = _compare(results, baseline, args.max_regression)
+        if regressions:
+            print(f"Regressions found: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import argparse
+import subprocess
+import sys
+
+# Modules that must not be loaded at import time, as they are slow to import
+# and not needed by every user
+LAZY_MODULES = ["simplepyble"]
+
+DEFAULT_MODULES = ["miramode", "miramode.decoder", "miramode.cli"]
+
+
+def measure_import(module):
+    # Returns the cumulative import time in microseconds and the names of
+    # all the modules imported, as reported by "python -X importtime"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True)
+
+    import_time = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            import_time = int(cumulative)
+    return import_time, imported
+
+
+def best_import_time(module, repeat):
+    # The first run also makes sure that the bytecode cache is up to date
+    measure_import(module)
+    return min(measure_import(module)[0] for _ in range(repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=10,
+        help="Number of runs for each module, the fastest one is kept")
+    parser.add_argument(
+        "-b", "--budget", type=float, default=100,
+        help="Maximum import time of miramode.cli in milliseconds")
+    parser.add_argument(
+        "modules", nargs="*", default=DEFAULT_MODULES,
+        help="The modules to import")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        _, imported = measure_import(module)
+        eager = [m for m in LAZY_MODULES if m in imported]
+        if eager:
+            print(f"{module} imports {', '.join(eager)} eagerly")
+            failed = True
+
+        import_time = best_import_time(module, args.repeat) / 1000
+        status = ""
+        if module == "miramode.cli" and import_time > args.budget:
+            status = f"OVER BUDGET ({args.budget:.1f} ms)"
+            failed = True
+        print(f"{module:<28} {import_time:>10.1f} ms {status}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,45 @@
+import collections
+import concurrent.futures
+import functools
 import logging
+import queue
+import random
 import struct
-
-import retrying
-import simplepyble
+import threading
+import time
+
+from miramode.constants import (  # noqa: F401
+    FAILURE, MAGIC_ID, OPCODE_CLIENTS, OPCODE_CONTROL_OUTLETS,
+    OPCODE_DEVICE_SETTINGS, OPCODE_DEVICE_STATE, OPCODE_NICKNAME,
+    OPCODE_OUTLET_SETTINGS, OPCODE_PAIR_CLIENT, OPCODE_PRESETS,
+    OPCODE_START_PRESET, OPCODE_TECHNICAL_INFO, OPCODE_UNPAIR_CLIENT,
+    OUTLET_RUNNING, OUTLET_STOPPED, SUCCESS, TIMER_PAUSED, TIMER_RUNNING,
+    TIMER_STOPPED)
+from miramode import capture
+from miramode import crc
+from miramode import decoder
+from miramode import reassembly
+from miramode import records
+from miramode import transport
 
 logger = logging.getLogger(__name__)
 
 TIMEOUT = 1
+SCAN_CACHE_TTL = 30
+DEFAULT_RESPONSE_TIMEOUT = 5
+DEFAULT_PIPELINE_WINDOW = 4
+DEFAULT_WATCH_FAST_INTERVAL = 1
+DEFAULT_WATCH_SLOW_INTERVAL = 30
+DEFAULT_CONNECT_DEADLINE = 30
+DEFAULT_INITIAL_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 8
+DEFAULT_WRITE_CHUNK_INTERVAL = 0.02
+DEFAULT_STATE_MAX_AGE = 5
+
+# The default ATT MTU, 3 bytes of which are used by the ATT header
+DEFAULT_ATT_MTU = 23
+ATT_HEADER_LENGTH = 3
+MAX_ATTRIBUTE_LENGTH = 512
 
 UUID_DEVICE_NAME = "00002a00-0000-1000-8000-00805f9b34fb"
 UUID_MODEL_NUMBER = "00002a24-0000-1000-8000-00805f9b34fb"
@@ -15,41 +48,20 @@ UUID_MANUFACTURER = "00002a29-0000-1000-8000-00805f9b34fb"
 UUID_READ = "bccb0003-ca66-11e5-88a4-0002a5d5c51b"
 UUID_WRITE = "bccb0002-ca66-11e5-88a4-0002a5d5c51b"
 
-MAGIC_ID = 0x54d2ee63
-
-FAILURE = 0x80
-SUCCESS = 1
-
-TIMER_STOPPED = 0
-TIMER_RUNNING = 1
-TIMER_PAUSED = 3
+FRAME_CACHE_SIZE = 256
 
-OUTLET_RUNNING = 0x64
-OUTLET_STOPPED = 0
+_CLIENT_ID_STRUCT = struct.Struct(">I")
+_CRC_STRUCT = struct.Struct(">H")
 
 
 def _crc(data):
-    i = 0
-    i2 = 0xFFFF
-    while i < len(data):
-        b = data[i]
-        i3 = i2
-        for i2 in range(8):
-            i4 = 1
-            i5 = 1 if ((b >> (7 - i2)) & 1) == 1 else 0
-            if ((i3 >> 15) & 1) != 1:
-                i4 = 0
-            i3 = i3 << 1
-            if (i5 ^ i4) != 0:
-                i3 = i3 ^ 0x1021
-        i += 1
-        i2 = i3
-    return i2 & 0xFFFF
+    return crc.crc16(data)
 
 
 def _get_payload_with_crc(payload, client_id):
-    crc = _crc(payload + struct.pack(">I", client_id))
-    return payload + struct.pack(">H", crc)
+    payload_crc = crc.crc16(_CLIENT_ID_STRUCT.pack(client_id),
+                            crc.crc16(payload))
+    return payload + _CRC_STRUCT.pack(payload_crc)
 
 
 def _convert_temperature(celsius):
@@ -73,20 +85,148 @@ def _bits_to_list(bits, length):
     return bits_list
 
 
-def _split_chunks(data, chunk_size):
-    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+class _PeripheralCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._peripherals = {}
+        self._last_full_scan = None
+
+    def _is_fresh(self, timestamp):
+        return (timestamp is not None and
+                time.monotonic() - timestamp < self.ttl)
+
+    def add(self, peripheral):
+        with self._lock:
+            self._peripherals[peripheral.address().lower()] = (
+                time.monotonic(), peripheral)
+
+    def set_all(self, peripherals):
+        now = time.monotonic()
+        with self._lock:
+            for p in peripherals:
+                self._peripherals[p.address().lower()] = (now, p)
+            self._last_full_scan = now
+
+    def get(self, address):
+        with self._lock:
+            entry = self._peripherals.get(address.lower())
+            if entry and self._is_fresh(entry[0]):
+                return entry[1]
+
+    def get_all(self):
+        with self._lock:
+            if not self._is_fresh(self._last_full_scan):
+                return None
+            return [p for (timestamp, p) in self._peripherals.values()
+                    if self._is_fresh(timestamp)]
+
+    def discard(self, address):
+        with self._lock:
+            self._peripherals.pop(address.lower(), None)
+            self._last_full_scan = None
+
+    def clear(self):
+        with self._lock:
+            self._peripherals.clear()
+            self._last_full_scan = None
+
+
+_peripheral_cache = _PeripheralCache(SCAN_CACHE_TTL)
+_scan_lock = threading.Lock()
+_backend = None
+_active_scanner = None
+
+
+def set_backend(backend):
+    # Replaces the BLE backend, e.g. with a miramode.simulator backend
+    global _backend
+    _backend = backend
+    _peripheral_cache.clear()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = transport.SimplepybleBackend()
+    return _backend
+
+
+def set_scan_cache_ttl(ttl):
+    _peripheral_cache.ttl = ttl
+
+
+def clear_scan_cache():
+    _peripheral_cache.clear()
+
+
+def _set_active_scanner(scanner):
+    # Set by miramode.scanner.BackgroundScanner while running
+    global _active_scanner
+    _active_scanner = scanner
+
+
+def _get_adapter():
+    return get_backend().get_adapter()
 
 
-def _get_peripherals():
-    adapters = simplepyble.Adapter.get_adapters()
-    adapter = adapters[0]
-    adapter.scan_for(TIMEOUT * 1000)
-    return adapter.scan_get_results()
+def _get_peripherals(use_cache=True):
+    if use_cache and _active_scanner is None:
+        peripherals = _peripheral_cache.get_all()
+        if peripherals is not None:
+            return peripherals
 
+    with _scan_lock:
+        # The background scanner owns the adapter's scan while running
+        scanner = _active_scanner
+        if scanner is not None:
+            return scanner.get_peripherals()
+        adapter = _get_adapter()
+        adapter.scan_for(TIMEOUT * 1000)
+        peripherals = adapter.scan_get_results()
+
+    _peripheral_cache.set_all(peripherals)
+    return peripherals
+
+
+def _find_peripheral(address, timeout=TIMEOUT, use_cache=True):
+    if use_cache:
+        peripheral = _peripheral_cache.get(address)
+        if peripheral is not None:
+            return peripheral
 
-def get_available_devices():
+    found = threading.Event()
+    result = []
+
+    def _on_scan_found(peripheral):
+        _peripheral_cache.add(peripheral)
+        if peripheral.address().lower() == address.lower():
+            result.append(peripheral)
+            found.set()
+
+    with _scan_lock:
+        # The background scanner owns the adapter's scan while running
+        scanner = _active_scanner
+        if scanner is None:
+            adapter = _get_adapter()
+            adapter.set_callback_on_scan_found(_on_scan_found)
+            adapter.scan_start()
+            try:
+                # Stop as soon as the requested address shows up
+                found.wait(timeout)
+            finally:
+                adapter.scan_stop()
+                adapter.set_callback_on_scan_found(lambda peripheral: None)
+
+    if scanner is not None:
+        return scanner.wait_for(address, timeout)
+    if result:
+        return result[0]
+
+
+def get_available_devices(use_cache=True):
     devices = []
-    peripherals = _get_peripherals()
+    peripherals = _get_peripherals(use_cache)
     for p in peripherals:
         if "Mira" in p.identifier():
             devices.append((p.identifier(), p.address()))
@@ -139,32 +279,345 @@ class NotificationsBase():
         pass
 
 
+class RecordNotifications(NotificationsBase):
+    # Converts each notification into the matching miramode.records type
+    def record(self, record):
+        pass
+
+    def client_details(self, *args):
+        self.record(records.ClientDetails(*args))
+
+    def controls_operated(self, *args):
+        self.record(records.ControlsOperated(*args))
+
+    def device_settings(self, *args):
+        self.record(records.DeviceSettings(*args))
+
+    def device_state(self, *args):
+        self.record(records.DeviceState(*args))
+
+    def nickname(self, *args):
+        self.record(records.Nickname(*args))
+
+    def outlet_settings(self, *args):
+        self.record(records.OutletSettings(*args))
+
+    def preset_details(self, *args):
+        self.record(records.PresetDetails(*args))
+
+    def slots(self, *args):
+        self.record(records.Slots(*args))
+
+    def success_or_failure(self, *args):
+        self.record(records.SuccessOrFailure(*args))
+
+    def technical_information(self, *args):
+        self.record(records.TechnicalInformation(*args))
+
+
+class _WatchNotifications(RecordNotifications):
+    def __init__(self, records_queue, forward_to):
+        self._records_queue = records_queue
+        self._forward_to = forward_to
+
+    def record(self, record):
+        if record.kind in (records.DeviceState.kind,
+                           records.ControlsOperated.kind):
+            self._records_queue.put(record)
+        if self._forward_to is not None:
+            decoder.dispatch(self._forward_to, record)
+
+
+def _to_device_state(record):
+    if record.kind == records.ControlsOperated.kind:
+        # Same fields as the device state, plus change_made
+        return records.DeviceState(record[0], *record[2:])
+    return record
+
+
+# Notifications carrying the full device state
+_STATE_KINDS = frozenset([records.DeviceState.kind,
+                          records.ControlsOperated.kind])
+
+# Commands changing the device state
+_STATE_CHANGING_OPCODES = frozenset([OPCODE_CONTROL_OUTLETS,
+                                     OPCODE_START_PRESET])
+
+
+def _is_device_active(state):
+    return (state.outlet_state_1 or state.outlet_state_2 or
+            (state.timer_state == TIMER_RUNNING and
+             state.remaining_seconds > 0))
+
+
+class CommandFailedError(Exception):
+    pass
+
+
+class DeviceNotFoundError(Exception):
+    pass
+
+
+class ConnectFailedError(Exception):
+    pass
+
+
+class ResponseTimeoutError(Exception):
+    pass
+
+
+class PendingResponse(concurrent.futures.Future):
+    # The result of a request, resolved with the miramode.records instance
+    # of the first matching notification received after the request was sent.
+    # match, if set, checks the fields identifying the response, e.g. the
+    # slot, so that a lost response is not replaced by a later one.
+    def __init__(self, opcode, kinds, timeout, match=None):
+        super().__init__()
+        self.opcode = opcode
+        self.kinds = kinds
+        self.match = match
+        self.created = time.monotonic()
+        self.deadline = self.created + timeout
+
+    def matches(self, record):
+        return (record.kind in self.kinds and
+                (self.match is None or self.match(record)))
+
+    def is_expired(self):
+        return time.monotonic() >= self.deadline
+
+    def expire(self):
+        try:
+            self.set_exception(ResponseTimeoutError(
+                f"No response received for opcode: {self.opcode:#04x}"))
+        except concurrent.futures.InvalidStateError:
+            pass
+
+    def result(self, timeout=None):
+        if timeout is None:
+            timeout = max(0, self.deadline - time.monotonic())
+        else:
+            # Waiting longer than the connection's response timeout must not
+            # let other notifications expire the request in the meantime
+            self.deadline = max(self.deadline, time.monotonic() + timeout)
+        try:
+            return super().result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.expire()
+            return super().result(0)
+
+
+class ReconnectPolicy:
+    # Connection attempts are retried with an exponential backoff until the
+    # deadline expires. jitter is the fraction of each delay that is
+    # randomized, to avoid many clients retrying in lockstep.
+    # With auto_reconnect, a lost link is connected again in the background.
+    def __init__(self, deadline=DEFAULT_CONNECT_DEADLINE,
+                 initial_backoff=DEFAULT_INITIAL_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, multiplier=2, jitter=0.5,
+                 scan_timeout=TIMEOUT, auto_reconnect=True):
+        self.deadline = deadline
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.scan_timeout = scan_timeout
+        self.auto_reconnect = auto_reconnect
+
+    def get_backoff(self, attempt):
+        delay = min(self.max_backoff,
+                    self.initial_backoff * self.multiplier ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+
 class Connnection:
-    def __init__(self, address, client_id=None, client_slot=None):
+    def __init__(self, address, client_id=None, client_slot=None,
+                 response_timeout=DEFAULT_RESPONSE_TIMEOUT,
+                 reconnect_policy=None, metrics=None,
+                 write_chunk_interval=DEFAULT_WRITE_CHUNK_INTERVAL):
         self._address = address
+        self._max_write_length = DEFAULT_ATT_MTU - ATT_HEADER_LENGTH
+        self._write_chunk_interval = write_chunk_interval
+        self._metrics = metrics
         self._peripheral = None
+        self._reconnect_policy = reconnect_policy or ReconnectPolicy()
+        self._lifecycle_lock = threading.Lock()
+        self._connected_event = threading.Event()
+        self._closed = threading.Event()
+        self._reconnect_thread = None
         self._client_id = client_id
         self._client_slot = client_slot
+        self._frame_cache = {}
+        self._characteristic_index = None
+        self._characteristic_index_hits = 0
+        self._characteristic_index_misses = 0
+        self._notifications = None
+        self._subscribed = False
+        self._response_timeout = response_timeout
+        self._pending = collections.deque()
+        self._pending_lock = threading.Lock()
+        self._reassembler = reassembly.Reassembler()
+        self._capture = None
+        self._owns_capture = False
+        # A (DeviceState, monotonic time) tuple
+        self._state_cache = None
+        self._state_cache_hits = 0
+        self._state_cache_misses = 0
 
     def set_client_data(self, client_id, client_slot):
         self._client_id = client_id
         self._client_slot = client_slot
 
-    @retrying.retry(stop_max_attempt_number=10)
-    def connect(self):
-        peripherals = _get_peripherals()
-        pl = [p for p in peripherals if
-              p.address().lower() == self._address.lower()]
-        if not len(pl):
-            raise Exception(f"Address not found: {self._address}")
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def connected(self):
+        return self._peripheral is not None
 
-        peripheral = pl[0]
-        peripheral.connect()
+    def set_metrics(self, metrics):
+        # metrics is a miramode.metrics.MetricsBase instance, or None to
+        # disable the metrics
+        self._metrics = metrics
 
-        self._peripheral = peripheral
+    @property
+    def reconnecting(self):
+        return self._reconnect_thread is not None
+
+    def connect(self):
+        self._closed.clear()
+        self._connect_with_backoff()
+        self._connected_event.set()
+
+    def _connect_with_backoff(self):
+        policy = self._reconnect_policy
+        deadline = time.monotonic() + policy.deadline
+        attempt = 0
+        while True:
+            scan_timeout = max(0, min(policy.scan_timeout,
+                                      deadline - time.monotonic()))
+            try:
+                self._connect(scan_timeout)
+                return
+            except (DeviceNotFoundError, ConnectFailedError) as ex:
+                delay = policy.get_backoff(attempt)
+                attempt += 1
+                if time.monotonic() + delay >= deadline:
+                    raise
+                logger.info(f"Connection attempt {attempt} failed, retrying "
+                            f"in {delay:.2f} seconds: {ex}")
+            # A disconnect() call cancels the pending attempts
+            if self._closed.wait(delay):
+                raise ConnectFailedError(
+                    f"Disconnected while connecting: {self._address}")
+
+    def _connect(self, scan_timeout):
+        metrics = self._metrics
+        if metrics is not None:
+            started = time.monotonic()
+        peripheral = _find_peripheral(self._address, scan_timeout)
+        if metrics is not None:
+            metrics.scan_completed(self._address, time.monotonic() - started,
+                                   peripheral is not None)
+        if peripheral is None:
+            raise DeviceNotFoundError(
+                f"Address not found: {self._address}")
+
+        if metrics is not None:
+            started = time.monotonic()
+        try:
+            peripheral.connect()
+        except Exception as ex:
+            if metrics is not None:
+                metrics.connect_completed(
+                    self._address, time.monotonic() - started, False)
+            # The cached peripheral might be stale, rescan on the next attempt
+            _peripheral_cache.discard(self._address)
+            raise ConnectFailedError(
+                f"Cannot connect to {self._address}: {ex}") from ex
+        if metrics is not None:
+            metrics.connect_completed(
+                self._address, time.monotonic() - started, True)
+
+        with self._lifecycle_lock:
+            self._peripheral = peripheral
+            self._subscribed = False
+            self._reassembler.reset()
+            self._max_write_length = self._get_max_write_length(peripheral)
+        peripheral.set_callback_on_disconnected(
+            lambda: self._on_disconnected(peripheral))
+        self._build_characteristic_index()
 
     def disconnect(self):
-        self._peripheral = None
+        self._closed.set()
+        reconnect_thread = self._reconnect_thread
+        if (reconnect_thread is not None and
+                reconnect_thread is not threading.current_thread()):
+            reconnect_thread.join()
+
+        with self._lifecycle_lock:
+            peripheral = self._peripheral
+            self._peripheral = None
+            self._characteristic_index = None
+            self._subscribed = False
+            self._state_cache = None
+            self._connected_event.clear()
+
+        if peripheral is not None:
+            # Closing the link on purpose is not a link loss
+            peripheral.set_callback_on_disconnected(lambda: None)
+            try:
+                if peripheral.is_connected():
+                    peripheral.disconnect()
+            except Exception:
+                logger.exception(f"Cannot disconnect from {self._address}")
+        self._fail_pending(Exception("Disconnected"))
+
+    def _on_disconnected(self, peripheral):
+        # Invoked by the BLE library when the link drops
+        with self._lifecycle_lock:
+            if peripheral is not self._peripheral or self._closed.is_set():
+                return
+            logger.warning(f"Connection lost: {self._address}")
+            resubscribe = self._subscribed
+            self._peripheral = None
+            self._characteristic_index = None
+            self._subscribed = False
+            self._state_cache = None
+            self._connected_event.clear()
+            if (self._reconnect_policy.auto_reconnect and
+                    self._reconnect_thread is None):
+                self._reconnect_thread = threading.Thread(
+                    target=self._reconnect, args=(resubscribe,),
+                    daemon=True, name=f"miramode-reconnect-{self._address}")
+                self._reconnect_thread.start()
+        self._fail_pending(Exception("Connection lost"))
+
+    def _reconnect(self, resubscribe):
+        try:
+            self._connect_with_backoff()
+            if resubscribe and self._notifications is not None:
+                self.subscribe(self._notifications)
+            self._connected_event.set()
+            logger.info(f"Reconnected: {self._address}")
+        except Exception:
+            if not self._closed.is_set():
+                logger.exception(f"Cannot reconnect to {self._address}")
+        finally:
+            self._reconnect_thread = None
+
+    def _ensure_connected(self):
+        # Commands sent while reconnecting wait for the link to be restored
+        if not self._connected_event.is_set() and self.reconnecting:
+            self.wait_connected(self._response_timeout)
+        if self._peripheral is None:
+            raise Exception(f"Not connected: {self._address}")
+
+    def wait_connected(self, timeout=None):
+        # Returns True once connected, waiting for any reconnection in
+        # progress
+        return self._connected_event.wait(timeout)
 
     def __enter__(self):
         self.connect()
@@ -177,161 +630,401 @@ class Connnection:
         service = self._get_service_for_characteristic(characteristic)
         return self._peripheral.read(service, characteristic)
 
-    def _write_chunks(self, data, chunk_size=20):
-        for chunk in _split_chunks(data, chunk_size):
-            self._write(chunk)
+    def _get_max_write_length(self, peripheral):
+        # A write without response carries up to the negotiated MTU minus
+        # the ATT header
+        try:
+            mtu = peripheral.mtu()
+        except Exception:
+            logger.debug("Cannot get the MTU, using the default one")
+            mtu = DEFAULT_ATT_MTU
+        return min(MAX_ATTRIBUTE_LENGTH,
+                   max(DEFAULT_ATT_MTU, mtu) - ATT_HEADER_LENGTH)
+
+    @property
+    def max_write_length(self):
+        return self._max_write_length
+
+    def _send_frame(self, frame):
+        # Every outbound frame goes through here. Frames longer than a
+        # single write are split in chunks, paced by write_chunk_interval
+        # as writes without response have no flow control and the device
+        # drops the chunks it cannot keep up with
+        chunk_size = self._max_write_length
+        if len(frame) <= chunk_size:
+            self._write(frame)
+            return
+
+        view = memoryview(frame)
+        for offset in range(0, len(view), chunk_size):
+            if offset and self._write_chunk_interval:
+                time.sleep(self._write_chunk_interval)
+            self._write(view[offset:offset + chunk_size])
 
     def _write(self, data):
         logger.debug(f"Writing data: {_format_bytearray(data)}")
+        self._ensure_connected()
         service = self._get_service_for_characteristic(UUID_WRITE)
-        self._peripheral.write_command(service, UUID_WRITE, bytes(data))
-
-    def _get_service_for_characteristic(self, characteristic):
-        services = self._peripheral.services()
-        for service in services:
+        data = bytes(data)
+        if self._capture is not None:
+            self._capture.write(capture.DIRECTION_OUT, data)
+        self._peripheral.write_command(service, UUID_WRITE, data)
+
+    def start_capture(self, path_or_writer):
+        # Records all writes and notifications, see miramode.capture
+        self.stop_capture()
+        if isinstance(path_or_writer, capture.CaptureWriter):
+            self._capture = path_or_writer
+            self._owns_capture = False
+        else:
+            self._capture = capture.CaptureWriter(path_or_writer)
+            self._owns_capture = True
+
+    def stop_capture(self):
+        capture_writer = self._capture
+        self._capture = None
+        if capture_writer is not None:
+            if self._owns_capture:
+                capture_writer.close()
+            else:
+                capture_writer.flush()
+
+    def _get_frame(self, opcode, args=b"", client_slot=None, client_id=None):
+        if client_slot is None:
+            client_slot = self._client_slot
+        if client_id is None:
+            client_id = self._client_id
+
+        key = (client_slot, opcode, bytes(args), client_id)
+        frame = self._frame_cache.get(key)
+        if frame is None:
+            payload = bytearray([client_slot, opcode, len(args)]) + args
+            frame = bytes(_get_payload_with_crc(payload, client_id))
+            if len(self._frame_cache) >= FRAME_CACHE_SIZE:
+                self._frame_cache.clear()
+            self._frame_cache[key] = frame
+        return frame
+
+    def _build_characteristic_index(self):
+        index = {}
+        for service in self._peripheral.services():
             for c in service.characteristics():
                 logger.debug(f'Found service: "{service.uuid()}", '
                              f'characteristic: "{c.uuid()}"')
-                if c.uuid() == characteristic:
-                    return service.uuid()
-        raise Exception(f"Characteristic not found: {characteristic}")
+                index[c.uuid()] = service.uuid()
+        self._characteristic_index = index
+
+    def invalidate_characteristic_index(self):
+        self._characteristic_index = None
+
+    @property
+    def characteristic_index_stats(self):
+        return {
+            "hits": self._characteristic_index_hits,
+            "misses": self._characteristic_index_misses,
+        }
+
+    def _get_service_for_characteristic(self, characteristic):
+        if self._characteristic_index is not None:
+            service = self._characteristic_index.get(characteristic)
+            if service is not None:
+                self._characteristic_index_hits += 1
+                return service
+
+        # The index is missing or stale, rebuild it once before giving up
+        self._characteristic_index_misses += 1
+        self._build_characteristic_index()
+        service = self._characteristic_index.get(characteristic)
+        if service is None:
+            raise Exception(f"Characteristic not found: {characteristic}")
+        return service
 
     def subscribe(self, notifications):
-        notifications.partial_payload = bytearray()
-        notifications.client_slot = None
-        notifications.expected_payload_length = None
+        # Subscribing again on the same link just replaces the target
+        self._notifications = notifications
+        if self._subscribed:
+            return
 
+        self._reassembler.reset()
         service = self._get_service_for_characteristic(UUID_READ)
 
         self._peripheral.notify(
             service, UUID_READ, lambda value: self._handle_data(
-                value, notifications))
+                value, self._notifications))
+        self._subscribed = True
+
+    @property
+    def reassembly_stats(self):
+        return self._reassembler.stats
+
+    def _dispatch(self, notifications, record):
+        self._update_state_cache(record)
+        try:
+            decoder.dispatch(notifications, record)
+        finally:
+            self._resolve_pending(record)
+
+    def _update_state_cache(self, record):
+        kind = record.kind
+        if kind in _STATE_KINDS:
+            self._state_cache = (_to_device_state(record), time.monotonic())
+        elif kind == records.OutletSettings.kind:
+            # The counter is incremented by every successful update command,
+            # a different value means that the state changed since cached
+            cache = self._state_cache
+            if (cache is not None and
+                    cache[0].succesful_update_command_counter !=
+                    record.succesful_update_command_counter):
+                self._state_cache = None
+
+    def invalidate_state_cache(self):
+        self._state_cache = None
+
+    @property
+    def state_cache_stats(self):
+        return {
+            "hits": self._state_cache_hits,
+            "misses": self._state_cache_misses,
+        }
+
+    def get_cached_device_state(self, max_age=DEFAULT_STATE_MAX_AGE):
+        # Returns the last device state received, either requested or pushed
+        # by the device, if not older than max_age seconds. None otherwise.
+        cache = self._state_cache
+        if cache is not None and time.monotonic() - cache[1] <= max_age:
+            self._state_cache_hits += 1
+            return cache[0]
+        self._state_cache_misses += 1
+        return None
+
+    def get_device_state(self, max_age=DEFAULT_STATE_MAX_AGE, timeout=None):
+        # Like request_device_state(), but served from the state cache when
+        # recent enough
+        state = self.get_cached_device_state(max_age)
+        if state is not None:
+            return state
+        return self.request_device_state().result(timeout)
+
+    def _resolve_pending(self, record):
+        is_failure = (record.kind == records.SuccessOrFailure.kind and
+                      record.status == FAILURE)
+        expired = []
+        matched = None
+        with self._pending_lock:
+            for response in self._pending:
+                if response.done():
+                    continue
+                if response.is_expired():
+                    expired.append(response)
+                # A failure is reported for the oldest request, whatever its
+                # expected response type
+                elif is_failure or response.matches(record):
+                    matched = response
+                    break
+            self._pending = collections.deque(
+                r for r in self._pending
+                if not r.done() and r is not matched and r not in expired)
+
+        for response in expired:
+            response.expire()
+        if matched is None:
+            return
+        try:
+            if is_failure:
+                matched.set_exception(CommandFailedError(
+                    f"The command failed, opcode: {matched.opcode:#04x}"))
+            else:
+                matched.set_result(record)
+        except concurrent.futures.InvalidStateError:
+            # Timed out or cancelled in the meantime
+            pass
+
+    def _fail_pending(self, exception):
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = collections.deque()
+        for response in pending:
+            try:
+                response.set_exception(exception)
+            except concurrent.futures.InvalidStateError:
+                pass
+
+    def _expect_response(self, opcode, kinds, match=None):
+        self._ensure_connected()
+        # Responses are received only after subscribing, keep the caller's
+        # target, e.g. after connecting again
+        if not self._subscribed:
+            self.subscribe(self._notifications or NotificationsBase())
+        response = PendingResponse(
+            opcode, kinds, self._response_timeout, match)
+        metrics = self._metrics
+        if metrics is not None:
+            metrics.request_sent(self._address, opcode)
+            response.add_done_callback(
+                functools.partial(self._record_response, metrics))
+        with self._pending_lock:
+            # Expire the requests no one waits for, e.g. on a silent link, so
+            # that their timeouts are reported as well
+            expired = [r for r in self._pending
+                       if not r.done() and r.is_expired()]
+            if expired:
+                self._pending = collections.deque(
+                    r for r in self._pending
+                    if not r.done() and r not in expired)
+            self._pending.append(response)
+        for expired_response in expired:
+            expired_response.expire()
+        return response
+
+    def _record_response(self, metrics, response):
+        if response.cancelled():
+            return
+        ex = response.exception()
+        if ex is None:
+            metrics.response_received(
+                self._address, response.opcode,
+                time.monotonic() - response.created)
+        elif isinstance(ex, CommandFailedError):
+            metrics.command_failed(
+                self._address, response.opcode,
+                time.monotonic() - response.created)
+        elif isinstance(ex, ResponseTimeoutError):
+            metrics.response_timed_out(self._address, response.opcode)
+
+    def _request(self, opcode, kinds, args=b"", match=None):
+        if opcode in _STATE_CHANGING_OPCODES:
+            # Cached until the response with the new state arrives
+            self._state_cache = None
+        response = self._expect_response(opcode, kinds, match)
+        try:
+            self._send_frame(self._get_frame(opcode, args))
+        except Exception:
+            response.cancel()
+            raise
+        return response
 
     def _handle_data(self, value, notifications):
-        if len(notifications.partial_payload) > 0:
-            notifications.partial_payload.extend(value)
-            client_slot = notifications.client_slot
-            payload = notifications.partial_payload
-            payload_length = notifications.expected_payload_length
-
-            notifications.partial_payload = bytearray()
-            notifications.client_slot = None
-            notifications.expected_payload_length = None
-        else:
-            if len(value) < 2:
-                logger.warning(
-                    f"Packet length is too short, skipping: {len(value)}")
-                return
-
-            client_slot = value[0] - 0x40
-            payload_length = value[2]
-            payload = value[3:]
+        if self._capture is not None:
+            self._capture.write(capture.DIRECTION_IN, value)
 
-        if len(payload) < payload_length:
-            notifications.client_slot = client_slot
-            notifications.expected_payload_length = payload_length
-            notifications.partial_payload.extend(payload)
+        metrics = self._metrics
+        if metrics is None:
+            result = self._reassembler.feed(value)
+        else:
+            result = self._feed_with_metrics(value, metrics)
+        if result is None:
             return
+        client_slot, payload = result
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Payload length: {len(payload)}, "
+                f"payload : {_format_bytearray(payload)}")
 
-        if len(payload) != payload_length:
-            logger.warning(
-                "Inconsistent payload length, skipping: "
-                f"{payload_length}, {len(payload)}")
+        record = decoder.decode(client_slot, payload)
+        if record is None:
+            logger.debug(f"Unrecognized payload, length: {len(payload)}")
             return
 
-        logger.debug(
-            f"Payload length: {payload_length}, "
-            f"payload : {_format_bytearray(payload)}")
-
-        if payload_length == 1:
-            notifications.success_or_failure(client_slot, payload[0])
-
-        elif payload_length == 2:
-            slots = []
-            slot_bits = struct.unpack(">H", payload)[0]
-            slots = _bits_to_list(slot_bits, 16)
-
-            notifications.slots(client_slot, slots)
-
-        elif payload_length == 4:
-            outlet_enabled = _bits_to_list(payload[1], 8)
-            default_preset_slot = payload[2]
-            controller_senntings = _bits_to_list(payload[3], 8)
-
-            notifications.device_settings(
-                client_slot, outlet_enabled, default_preset_slot,
-                controller_senntings)
-
-        elif payload_length == 10:
-            timer_state = payload[0]
-            target_temperature = _convert_temperature_reverse(payload[1:3])
-            actual_temperature = _convert_temperature_reverse(payload[3:5])
-            outlet_state_1 = payload[5] == OUTLET_RUNNING
-            outlet_state_2 = payload[6] == OUTLET_RUNNING
-            remaining_seconds = struct.unpack(">H", payload[7:9])[0]
-            succesful_update_command_counter = payload[9]
-
-            notifications.device_state(
-                client_slot, timer_state, target_temperature,
-                actual_temperature, outlet_state_1, outlet_state_2,
-                remaining_seconds, succesful_update_command_counter)
-
-        elif payload_length == 11 and payload[0] in [1, 0x80]:
-            change_made = payload[0] == 1
-            timer_state = payload[1]
-            target_temperature = _convert_temperature_reverse(payload[2:4])
-            actual_temperature = _convert_temperature_reverse(payload[4:6])
-            outlet_state_1 = payload[6] == OUTLET_RUNNING
-            outlet_state_2 = payload[7] == OUTLET_RUNNING
-            remaining_seconds = struct.unpack(">H", payload[8:10])[0]
-            succesful_update_command_counter = payload[10]
-
-            notifications.controls_operated(
-                client_slot, change_made, timer_state, target_temperature,
-                actual_temperature, outlet_state_1, outlet_state_2,
-                remaining_seconds, succesful_update_command_counter)
-
-        elif payload_length == 11 and payload[0] in [0, 0x4, 0x8]:
-            outlet_flag = payload[0]
-            min_duration_seconds = payload[4]
-            max_temperature = _convert_temperature_reverse(payload[5:7])
-            min_temperature = _convert_temperature_reverse(payload[7:9])
-            succesful_update_command_counter = payload[10]
-
-            notifications.outlet_settings(
-                client_slot, outlet_flag, min_duration_seconds,
-                max_temperature, min_temperature,
-                succesful_update_command_counter)
-
-        elif payload_length == 16 and payload[0] == 0:
-            valve_type = payload[1]
-            valve_sw_version = payload[3]
-            ui_type = payload[5]
-            ui_sw_version = payload[7]
-            bt_sw_version = payload[15]
-
-            notifications.technical_information(
-                client_slot, valve_type, valve_sw_version, ui_type,
-                ui_sw_version, bt_sw_version)
-
-        elif payload_length == 16 and payload[0] != 0:
-            nickname = payload.decode('UTF-8')
-            notifications.nickname(client_slot, nickname)
-
-        elif payload_length == 20:
-            client_name = payload.decode('UTF-8')
-            notifications.client_details(client_slot, client_name)
-
-        elif payload_length == 24:
-            preset_slot = payload[0]
-            target_temperature = _convert_temperature_reverse(payload[1:3])
-            duration_seconds = payload[4]
-            outlet_enabled = _bits_to_list(payload[5], 8)
-            preset_name = payload[8:].decode('UTF-8')
-
-            notifications.preset_details(
-                client_slot, preset_slot, target_temperature, duration_seconds,
-                outlet_enabled, preset_name)
+        self._dispatch(notifications, record)
+
+    def _feed_with_metrics(self, value, metrics):
+        reassembler = self._reassembler
+        fragmented = reassembler.fragmented
+        dropped = reassembler.short + reassembler.oversized + reassembler.stale
+        metrics.notification_received(self._address, len(value))
+
+        result = reassembler.feed(value)
+
+        if reassembler.fragmented != fragmented:
+            metrics.packet_fragmented(self._address)
+        if (reassembler.short + reassembler.oversized + reassembler.stale !=
+                dropped):
+            metrics.packet_dropped(self._address)
+        return result
+
+    def pipeline(self, requests, window=DEFAULT_PIPELINE_WINDOW,
+                 timeout=None, return_exceptions=False):
+        # Each request is a callable returning a PendingResponse, e.g.:
+        # functools.partial(conn.request_client_details, client_slot).
+        # Up to "window" requests are in flight at any time and the results
+        # are returned in the same order as the requests.
+        if window < 1:
+            raise ValueError("The pipeline window must be at least 1")
+
+        results = []
+        in_flight = collections.deque()
+
+        def _collect():
+            response = in_flight.popleft()
+            try:
+                results.append(response.result(timeout))
+            except Exception as ex:
+                if not return_exceptions:
+                    raise
+                results.append(ex)
+
+        for request in requests:
+            if len(in_flight) >= window:
+                _collect()
+            in_flight.append(request())
+        while in_flight:
+            _collect()
+        return results
+
+    def get_clients(self, window=DEFAULT_PIPELINE_WINDOW, timeout=None):
+        slots = self.request_client_slots().result(timeout).slots
+        details = self.pipeline(
+            [functools.partial(self.request_client_details, slot)
+             for slot in slots], window, timeout)
+        return [(slot, d.client_name) for slot, d in zip(slots, details)]
+
+    def get_presets(self, window=DEFAULT_PIPELINE_WINDOW, timeout=None):
+        slots = self.request_preset_slots().result(timeout).slots
+        return self.pipeline(
+            [functools.partial(self.request_preset_details, slot)
+             for slot in slots], window, timeout)
+
+    def watch(self, callback, fast_interval=DEFAULT_WATCH_FAST_INTERVAL,
+              slow_interval=DEFAULT_WATCH_SLOW_INTERVAL, stop_event=None):
+        # Invokes callback with a records.DeviceState each time the state
+        # changes, until stop_event is set. Changes are detected from the
+        # notifications sent by the device, while the state is polled every
+        # fast_interval seconds if the outlets or the timer are running,
+        # every slow_interval seconds otherwise.
+        if stop_event is None:
+            stop_event = threading.Event()
+        records_queue = queue.Queue()
+        previous_notifications = self._notifications
+        self.subscribe(_WatchNotifications(
+            records_queue, previous_notifications))
+
+        last_state = None
+        next_poll = 0
+        try:
+            while not stop_event.is_set():
+                now = time.monotonic()
+                if now >= next_poll:
+                    self.request_device_state()
+                    next_poll = now + slow_interval
+
+                try:
+                    # Wake up regularly to check stop_event
+                    record = records_queue.get(
+                        timeout=min(next_poll - now, 1))
+                except queue.Empty:
+                    continue
+
+                state = _to_device_state(record)
+                interval = (fast_interval if _is_device_active(state)
+                            else slow_interval)
+                next_poll = min(next_poll, time.monotonic() + interval)
+
+                if state != last_state:
+                    last_state = state
+                    callback(state)
+        finally:
+            self.subscribe(previous_notifications or NotificationsBase())
 
     def get_device_info(self):
         device_name = self._read(UUID_DEVICE_NAME).decode('UTF-8')
@@ -341,40 +1034,43 @@ class Connnection:
         return (device_name, manufacturer, model_number)
 
     def request_client_details(self, client_slot):
-        payload = bytearray([self._client_slot, 0x6b, 1, 0x10 + client_slot])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_CLIENTS, (records.ClientDetails.kind,),
+            bytes([0x10 + client_slot]))
 
     def request_client_slots(self):
-        payload = bytearray([self._client_slot, 0x6b, 1, 0])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_CLIENTS, (records.Slots.kind,), b"\x00")
 
     def request_device_settings(self):
-        payload = bytearray([self._client_slot, 0x3e, 0])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_DEVICE_SETTINGS, (records.DeviceSettings.kind,))
 
     def request_device_state(self):
-        payload = bytearray([self._client_slot, 0x7, 0])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_DEVICE_STATE, (records.DeviceState.kind,))
 
     def request_nickname(self):
-        payload = bytearray([self._client_slot, 0x44, 0])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(OPCODE_NICKNAME, (records.Nickname.kind,))
 
     def request_outlet_settings(self):
-        payload = bytearray([self._client_slot, 0x10, 0])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_OUTLET_SETTINGS, (records.OutletSettings.kind,))
 
     def request_preset_details(self, preset_slot):
-        payload = bytearray([self._client_slot, 0x30, 1, 0x40 + preset_slot])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_PRESETS, (records.PresetDetails.kind,),
+            bytes([0x40 + preset_slot]),
+            lambda record: record.preset_slot == preset_slot)
 
     def request_preset_slots(self):
-        payload = bytearray([self._client_slot, 0x30, 1, 0x80])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_PRESETS, (records.Slots.kind,), b"\x80")
 
     def request_technical_info(self):
-        payload = bytearray([self._client_slot, 0x32, 1, 1])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_TECHNICAL_INFO, (records.TechnicalInformation.kind,),
+            b"\x01")
 
     def pair_client(self, new_client_id, client_name):
         new_client_id_bytes = struct.pack(">I", new_client_id)
@@ -385,26 +1081,35 @@ class Connnection:
 
         client_name_bytes += bytearray([0] * (20 - len(client_name_bytes)))
 
-        payload = (bytearray([0, 0xeb, 24]) + new_client_id_bytes +
-                   client_name_bytes)
-        self._write_chunks(_get_payload_with_crc(payload, MAGIC_ID))
+        payload = (bytearray([0, OPCODE_PAIR_CLIENT, 24]) +
+                   new_client_id_bytes + client_name_bytes)
+        # On success, the status is the slot assigned to the new client
+        response = self._expect_response(
+            OPCODE_PAIR_CLIENT, (records.SuccessOrFailure.kind,))
+        try:
+            self._send_frame(_get_payload_with_crc(payload, MAGIC_ID))
+        except Exception:
+            response.cancel()
+            raise
+        return response
 
     def unpair_client(self, client_slot_to_unpair):
-        payload = bytearray(
-            [self._client_slot, 0xeb, 1, client_slot_to_unpair])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_UNPAIR_CLIENT, (records.SuccessOrFailure.kind,),
+            bytes([client_slot_to_unpair]))
 
     def control_outlets(self, outlet1, outlet2, temperature):
         temperature_bytes = _convert_temperature(temperature)
-        payload = bytearray([
-            self._client_slot,
-            0x87, 0x05,
+        args = bytes([
             TIMER_RUNNING if outlet1 or outlet2 else TIMER_PAUSED,
             temperature_bytes[0], temperature_bytes[1],
             OUTLET_RUNNING if outlet1 else OUTLET_STOPPED,
             OUTLET_RUNNING if outlet2 else OUTLET_STOPPED])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_CONTROL_OUTLETS, (records.ControlsOperated.kind,), args)
 
     def start_preset(self, preset_slot):
-        payload = bytearray([self._client_slot, 0xb1, 1, preset_slot])
-        self._write(_get_payload_with_crc(payload, self._client_id))
+        return self._request(
+            OPCODE_START_PRESET,
+            (records.ControlsOperated.kind, records.SuccessOrFailure.kind),
+            bytes([preset_slot]))
@@ -0,0 +1,182 @@
+import asyncio
+import concurrent.futures
+import time
+
+import miramode
+from miramode import scheduler
+
+DEFAULT_TIMEOUT = 5
+
+
+class _AsyncNotifications(miramode.RecordNotifications):
+    def __init__(self, loop, listeners):
+        self._loop = loop
+        self._listeners = listeners
+
+    def record(self, record):
+        # Called on the BLE thread, hand the record over to the event loop
+        self._loop.call_soon_threadsafe(self._dispatch, record)
+
+    def _dispatch(self, record):
+        for listener in self._listeners:
+            listener(record)
+
+
+class AsyncConnection:
+    def __init__(self, address, client_id=None, client_slot=None,
+                 timeout=DEFAULT_TIMEOUT, reconnect_policy=None,
+                 min_command_interval=None):
+        self._conn = miramode.Connnection(
+            address, client_id, client_slot, response_timeout=timeout,
+            reconnect_policy=reconnect_policy)
+        # With min_command_interval, outlet commands are coalesced and rate
+        # limited, see miramode.scheduler.OutletScheduler
+        self._outlet_scheduler = None
+        if min_command_interval is not None:
+            self._outlet_scheduler = scheduler.OutletScheduler(
+                self._conn, min_command_interval)
+        self._loop = None
+        self._listeners = []
+        # A single worker keeps the writes in the same order as the requests
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="miramode-aio")
+
+    @property
+    def connection(self):
+        return self._conn
+
+    def set_client_data(self, client_id, client_slot):
+        self._conn.set_client_data(client_id, client_slot)
+
+    def add_listener(self, callback):
+        # callback is invoked on the event loop with every decoded record
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    async def connect(self):
+        self._loop = asyncio.get_running_loop()
+        await self._run(self._conn.connect)
+        notifications = _AsyncNotifications(self._loop, self._listeners)
+        await self._run(self._conn.subscribe, notifications)
+
+    async def disconnect(self):
+        await self._run(self._conn.disconnect)
+
+    async def close(self):
+        if self._outlet_scheduler is not None:
+            await self._run(self._outlet_scheduler.close)
+        await self.disconnect()
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    def _run(self, func, *args):
+        return self._loop.run_in_executor(self._executor, func, *args)
+
+    async def _request(self, func, *args):
+        # The connection matches the response, this just awaits it
+        response = await self._run(func, *args)
+        timeout = max(0, response.deadline - time.monotonic())
+        future = asyncio.wrap_future(response)
+        # Unlike asyncio.wait_for(), this does not cancel the response on
+        # timeout, expiring it instead reports the timeout to the metrics
+        await asyncio.wait((future,), timeout=timeout)
+        if not future.done():
+            response.expire()
+        return await future
+
+    async def get_device_info(self):
+        return await self._run(self._conn.get_device_info)
+
+    async def client_details(self, client_slot):
+        return await self._request(
+            self._conn.request_client_details, client_slot)
+
+    async def client_slots(self):
+        record = await self._request(self._conn.request_client_slots)
+        return record.slots
+
+    async def device_settings(self):
+        return await self._request(self._conn.request_device_settings)
+
+    async def device_state(self):
+        return await self._request(self._conn.request_device_state)
+
+    async def get_device_state(self,
+                               max_age=miramode.DEFAULT_STATE_MAX_AGE):
+        # Served from the connection's state cache when recent enough
+        state = self._conn.get_cached_device_state(max_age)
+        if state is not None:
+            return state
+        return await self.device_state()
+
+    async def _pipeline(self, func, args_list, window):
+        # Like miramode.Connnection.pipeline(), up to "window" requests are
+        # in flight at any time. The executor is used only to send each
+        # request, so other calls can proceed in the meantime.
+        if window < 1:
+            raise ValueError("The pipeline window must be at least 1")
+        semaphore = asyncio.Semaphore(window)
+
+        async def _request(args):
+            async with semaphore:
+                return await self._request(func, *args)
+
+        return await asyncio.gather(*(_request(args) for args in args_list))
+
+    async def get_clients(self, window=miramode.DEFAULT_PIPELINE_WINDOW):
+        # Returns a list of (client_slot, client_name) tuples
+        slots = await self.client_slots()
+        details = await self._pipeline(
+            self._conn.request_client_details, [(s,) for s in slots], window)
+        return [(slot, d.client_name) for slot, d in zip(slots, details)]
+
+    async def get_presets(self, window=miramode.DEFAULT_PIPELINE_WINDOW):
+        slots = await self.preset_slots()
+        return await self._pipeline(
+            self._conn.request_preset_details, [(s,) for s in slots], window)
+
+    async def nickname(self):
+        record = await self._request(self._conn.request_nickname)
+        return record.nickname
+
+    async def outlet_settings(self):
+        return await self._request(self._conn.request_outlet_settings)
+
+    async def preset_details(self, preset_slot):
+        return await self._request(
+            self._conn.request_preset_details, preset_slot)
+
+    async def preset_slots(self):
+        record = await self._request(self._conn.request_preset_slots)
+        return record.slots
+
+    async def technical_info(self):
+        return await self._request(self._conn.request_technical_info)
+
+    async def pair_client(self, new_client_id, client_name):
+        record = await self._request(
+            self._conn.pair_client, new_client_id, client_name)
+        return record.status
+
+    async def unpair_client(self, client_slot_to_unpair):
+        return await self._request(
+            self._conn.unpair_client, client_slot_to_unpair)
+
+    async def control_outlets(self, outlet1, outlet2, temperature):
+        if self._outlet_scheduler is not None:
+            return await asyncio.wrap_future(
+                self._outlet_scheduler.control_outlets(
+                    outlet1, outlet2, temperature))
+        return await self._request(
+            self._conn.control_outlets, outlet1, outlet2, temperature)
+
+    async def start_preset(self, preset_slot):
+        return await self._request(self._conn.start_preset, preset_slot)
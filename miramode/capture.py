@@ -0,0 +1,105 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+from miramode import decoder
+from miramode import reassembly
+
+# A capture file starts with FILE_HEADER, followed by a sequence of entries,
+# each made of a little endian header (wall clock timestamp as a double,
+# direction, data length) and the data itself.
+FILE_HEADER = b"MMCAP\x01"
+
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+
+_ENTRY_HEADER = struct.Struct("<dBH")
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "ab")
+        if is_new:
+            self._file.write(FILE_HEADER)
+
+    def write(self, direction, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        header = _ENTRY_HEADER.pack(timestamp, direction, len(data))
+        with self._lock:
+            # Notifications might still arrive after closing
+            if self._file.closed:
+                return
+            self._file.write(header)
+            self._file.write(data)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def iter_capture(path):
+    # Yields (timestamp, direction, data) tuples
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(FILE_HEADER)] != FILE_HEADER:
+                raise Exception(f"Not a capture file: {path}")
+
+            offset = len(FILE_HEADER)
+            size = len(mm)
+            while offset + _ENTRY_HEADER.size <= size:
+                timestamp, direction, length = _ENTRY_HEADER.unpack_from(
+                    mm, offset)
+                offset += _ENTRY_HEADER.size
+                if offset + length > size:
+                    raise Exception(f"Truncated capture file: {path}")
+                yield timestamp, direction, mm[offset:offset + length]
+                offset += length
+
+
+def replay(path, notifications=None, realtime=False, speed=1.0):
+    # Feeds the captured notifications through the reassembler and the
+    # decoder, yielding (timestamp, record) tuples. If provided, the records
+    # are also dispatched to a miramode.NotificationsBase instance.
+    # With realtime set, the recorded pace is reproduced, scaled by speed.
+    reassembler = reassembly.Reassembler(stale_timeout=float("inf"))
+    first_timestamp = None
+    started = time.monotonic()
+
+    for timestamp, direction, data in iter_capture(path):
+        if direction != DIRECTION_IN:
+            continue
+
+        if realtime:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = ((timestamp - first_timestamp) / speed -
+                     (time.monotonic() - started))
+            if delay > 0:
+                time.sleep(delay)
+
+        result = reassembler.feed(data)
+        if result is None:
+            continue
+        record = decoder.decode(*result)
+        if record is None:
+            continue
+        if notifications is not None:
+            decoder.dispatch(notifications, record)
+        yield timestamp, record
@@ -1,18 +1,41 @@
 import argparse
+import contextlib
+import datetime
+import io
+import json
 import logging
 import random
+import shlex
 import sys
-import threading
+import time
 
 import miramode
+from miramode import capture
+from miramode import daemon
+from miramode import metadata
+from miramode import metrics
 
 CMD_LIST_DEVICES = "devices-list"
 CMD_GET_DEVICE_STATE = "device-state"
+CMD_WATCH_DEVICE = "device-watch"
 CMD_LIST_CLIENTS = "client-list"
+CMD_LIST_PRESETS = "preset-list"
 CMD_PAIR_CLIENT = "client-pair"
 CMD_UNPAIR_CLIENT = "client-unpair"
 CMD_CONTROL_OUTLETS = "outlets-control"
 CMD_START_PRESET = "preset-start"
+CMD_DAEMON = "daemon"
+CMD_REPLAY_CAPTURE = "capture-replay"
+CMD_BATCH = "batch"
+CMD_SHELL = "shell"
+CMD_SERVE = "serve"
+
+# Seconds added to the command and connection timeouts when waiting for the
+# daemon
+DAEMON_TIMEOUT_MARGIN = 5
+
+# Batch only command, pausing the execution for the given seconds
+BATCH_CMD_SLEEP = "sleep"
 
 OUTLET_STATE_STR = {
     miramode.OUTLET_STOPPED: "off",
@@ -67,11 +90,29 @@ def _valid_client_id(value):
         raise argparse.ArgumentTypeError(f"{value} is not a valid number.")
 
 
+def _valid_device(value):
+    # ADDRESS,CLIENT_ID,CLIENT_SLOT
+    try:
+        address, client_id, client_slot = value.rsplit(",", 2)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not in the ADDRESS,CLIENT_ID,CLIENT_SLOT format")
+    return (address, _valid_client_id(client_id), _valid_slot(client_slot))
+
+
 def _add_common_args(parser):
     parser.add_argument(
         '--debug', required=False,
         action='store_true',
         help="Set debug logging level")
+    parser.add_argument(
+        '--socket', required=False,
+        default=daemon.get_default_socket_path(),
+        help="The Unix domain socket of the connection daemon")
+    parser.add_argument(
+        '--no-daemon', required=False,
+        action='store_true',
+        help="Do not use the connection daemon, even if running")
 
 
 def _add_address_args(parser):
@@ -80,6 +121,13 @@ def _add_address_args(parser):
         "-a", "--address", required=True,
         type=str,
         help="The BLE address of the device")
+    parser.add_argument(
+        "--timeout", required=False,
+        type=float, default=miramode.DEFAULT_RESPONSE_TIMEOUT,
+        help="Seconds to wait for the device to respond")
+    parser.add_argument(
+        "--capture", required=False,
+        help="Append the BLE traffic to the given capture file")
 
 
 def _add_client_args(parser):
@@ -94,6 +142,46 @@ def _add_client_args(parser):
         help="The client slot corresponding to the client id")
 
 
+def _add_get_device_state_args(parser):
+    parser.add_argument(
+        "--max-age", required=False, type=float, default=0,
+        help="Return the state cached by the daemon if not older than the "
+        "given seconds")
+
+
+def _add_watch_device_args(parser):
+    parser.add_argument(
+        "--fast-interval", required=False,
+        type=float, default=miramode.DEFAULT_WATCH_FAST_INTERVAL,
+        help="Seconds between polls while the outlets or timer are running")
+    parser.add_argument(
+        "--slow-interval", required=False,
+        type=float, default=miramode.DEFAULT_WATCH_SLOW_INTERVAL,
+        help="Seconds between polls while the device is idle")
+
+
+def _add_pipeline_args(parser):
+    parser.add_argument(
+        "-w", "--window", required=False,
+        type=int, default=miramode.DEFAULT_PIPELINE_WINDOW,
+        help="The maximum number of requests sent without waiting for a "
+        "response")
+
+
+def _add_metadata_cache_args(parser):
+    parser.add_argument(
+        "--cache-file", required=False,
+        default=metadata.get_default_cache_path(),
+        help="The file caching the device metadata")
+    parser.add_argument(
+        "--no-cache", required=False, action="store_true",
+        help="Do not use the metadata cache, enabled by default")
+    parser.add_argument(
+        "--cache-max-age", required=False, type=float,
+        help="Answer from the cache without connecting if it was validated "
+        "by the device within the given seconds")
+
+
 def _add_pair_client_args(parser):
     parser.add_argument(
         "-c", "--client-id", required=False,
@@ -133,104 +221,183 @@ def _add_start_preset_args(parser):
         help="The slot of the preset to start")
 
 
-def _parse_args():
+def _add_batch_args(parser):
+    parser.add_argument(
+        "-f", "--file", required=False, default="-",
+        help="The file containing the commands, one per line, - for stdin. "
+        "Each line is either a command with its arguments, a JSON list of "
+        'arguments or a JSON object, e.g.: {"command": "preset-start", '
+        '"args": ["-p", "0"], "timeout": 10}')
+    parser.add_argument(
+        "-k", "--keep-going", required=False, action="store_true",
+        help="Execute the remaining commands after a failure")
+
+
+def _add_daemon_args(parser):
+    parser.add_argument(
+        "--idle-timeout", required=False,
+        type=int, default=daemon.DEFAULT_IDLE_TIMEOUT,
+        help="Seconds after which idle device connections are closed")
+    parser.add_argument(
+        "--metrics-port", required=False, type=int,
+        help="Serve Prometheus metrics over HTTP on the given port")
+    parser.add_argument(
+        "--metrics-host", required=False, default="127.0.0.1",
+        help="The address the metrics are served on")
+
+
+def _add_serve_args(parser):
+    parser.add_argument(
+        "-d", "--device", required=True, action="append",
+        type=_valid_device, dest="devices",
+        metavar="ADDRESS,CLIENT_ID,CLIENT_SLOT",
+        help="A device to expose, can be repeated")
+    parser.add_argument(
+        "--host", required=False, default="127.0.0.1",
+        help="The address the HTTP server listens on")
+    parser.add_argument(
+        "--port", required=False, type=int, default=8765,
+        help="The port the HTTP server listens on")
+    parser.add_argument(
+        "--timeout", required=False, type=float, default=10,
+        help="Seconds after which a queued or running command is abandoned")
+    parser.add_argument(
+        "--min-command-interval", required=False, type=float,
+        help="Coalesce the outlet commands of each device, sending them at "
+        "least the given seconds apart")
+
+
+def _add_replay_capture_args(parser):
+    parser.add_argument(
+        "-f", "--file", required=True,
+        help="The capture file to replay")
+    parser.add_argument(
+        "--realtime", required=False,
+        action='store_true',
+        help="Replay the notifications at the recorded pace")
+    parser.add_argument(
+        "--speed", required=False,
+        type=float, default=1.0,
+        help="The realtime replay speed factor")
+    parser.add_argument(
+        "--raw", required=False,
+        action='store_true',
+        help="Print the raw writes and notifications")
+
+
+# Command name: (help, argument adders)
+COMMAND_PARSERS = {
+    CMD_LIST_DEVICES: ("List devices", [_add_common_args]),
+    CMD_GET_DEVICE_STATE: (
+        "Get device state",
+        [_add_client_args, _add_get_device_state_args]),
+    CMD_WATCH_DEVICE: (
+        "Print the device state as JSON lines each time it changes",
+        [_add_client_args, _add_watch_device_args]),
+    CMD_LIST_CLIENTS: (
+        "List clients",
+        [_add_client_args, _add_pipeline_args, _add_metadata_cache_args]),
+    CMD_LIST_PRESETS: (
+        "List presets",
+        [_add_client_args, _add_pipeline_args, _add_metadata_cache_args]),
+    CMD_PAIR_CLIENT: (
+        "Pair a new client", [_add_address_args, _add_pair_client_args]),
+    CMD_UNPAIR_CLIENT: (
+        "Unpair an existing client",
+        [_add_client_args, _add_unpair_client_args]),
+    CMD_CONTROL_OUTLETS: (
+        "Turn on or off the outlets",
+        [_add_client_args, _add_control_outlets_args]),
+    CMD_START_PRESET: (
+        "Start a given preset", [_add_client_args, _add_start_preset_args]),
+    CMD_REPLAY_CAPTURE: (
+        "Decode a capture file",
+        [_add_common_args, _add_replay_capture_args]),
+    CMD_BATCH: (
+        "Execute a list of commands over a single connection, printing the "
+        "results as JSON lines",
+        [_add_client_args, _add_batch_args]),
+    CMD_SHELL: (
+        "Execute commands interactively over a single connection",
+        [_add_client_args]),
+    CMD_SERVE: (
+        "Expose devices over HTTP as JSON endpoints",
+        [_add_common_args, _add_serve_args]),
+    CMD_DAEMON: (
+        "Run a daemon that keeps device connections open",
+        [_add_common_args, _add_daemon_args]),
+}
+
+
+def _parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(
-        dest='command', required=True, help="Available commands")
-
-    list_devices_parser = subparsers.add_parser(
-        CMD_LIST_DEVICES, help="List devices",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    _add_common_args(list_devices_parser)
-
-    get_device_state_parser = subparsers.add_parser(
-        CMD_GET_DEVICE_STATE, help="Get device state",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    _add_client_args(get_device_state_parser)
-
-    list_clients_parser = subparsers.add_parser(
-        CMD_LIST_CLIENTS, help="List clients",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    _add_client_args(list_clients_parser)
-
-    pair_client_parser = subparsers.add_parser(
-        CMD_PAIR_CLIENT, help="Pair a new client",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    _add_address_args(pair_client_parser)
-    _add_pair_client_args(pair_client_parser)
-
-    unpair_client_parser = subparsers.add_parser(
-        CMD_UNPAIR_CLIENT, help="Unpair an existing client",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    _add_client_args(unpair_client_parser)
-    _add_unpair_client_args(unpair_client_parser)
-
-    control_outlets_parser = subparsers.add_parser(
-        CMD_CONTROL_OUTLETS, help="Turn on or off the outlets",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    _add_client_args(control_outlets_parser)
-    _add_control_outlets_args(control_outlets_parser)
-
-    start_preset_parser = subparsers.add_parser(
-        CMD_START_PRESET, help="Start a given preset",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    _add_client_args(start_preset_parser)
-    _add_start_preset_args(start_preset_parser)
+        dest='command', required=True, help="Available commands",
+        metavar="{" + ",".join(COMMAND_PARSERS) + "}")
+
+    # Building the subparsers is a noticeable part of the startup time, only
+    # the one of the requested command is needed
+    commands = COMMAND_PARSERS
+    if argv and argv[0] in COMMAND_PARSERS:
+        commands = {argv[0]: COMMAND_PARSERS[argv[0]]}
+
+    for command, (help, add_args_funcs) in commands.items():
+        command_parser = subparsers.add_parser(
+            command, help=help,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        for add_args in add_args_funcs:
+            add_args(command_parser)
 
     # If no arguments are provided, print help
-    if len(sys.argv) == 1:
+    if not argv:
         parser.print_help()
         for choice in subparsers.choices:
             print(f"\n{choice}\n")
             subparsers.choices[choice].print_help()
     else:
-        return parser.parse_args()
-
-
-class Notifications(miramode.NotificationsBase):
-    def __init__(self, event, is_pairing=False):
-        self._event = event
-        self._is_pairing = is_pairing
-
-    def client_details(self, client_slot, client_name):
-        print(f"{client_name}")
-        self._event.set()
-
-    def controls_operated(
-            self, client_slot, change_made, timer_state, target_temperature,
-            actual_temperature, outlet_state_1, outlet_state_2,
-            remaining_seconds, succesful_update_command_counter):
-        print(f"The command completed successfully")
-        self._event.set()
-
-    def device_state(
-            self, client_slot, timer_state, target_temperature,
-            actual_temperature, outlet_state_1, outlet_state_2,
-            remaining_seconds, succesful_update_command_counter):
-        print("Outlet 1: "
-              f"{OUTLET_STATE_STR.get(outlet_state_1, outlet_state_1)}")
-        print("Outlet 2: "
-              f"{OUTLET_STATE_STR.get(outlet_state_2, outlet_state_2)}")
-        print(f"Target temperature: {target_temperature:.1f}C")
-        print(f"Actual temperature: {actual_temperature:.1f}C")
-        print(f"Timer state: {TIMER_STATE_STR.get(timer_state, timer_state)}")
-        print(f"Remaining seconds: {remaining_seconds}")
-        self._event.set()
-
-    def slots(self, client_slot, slots):
-        self.slots = slots
-        self._event.set()
-
-    def success_or_failure(self, client_slot, status):
-        if status == miramode.FAILURE:
-            print(f"The command failed")
-        elif self._is_pairing:
-            print(f"Assigned client slot: {status}")
-        elif status == miramode.SUCCESS:
-            print(f"The command completed successfully")
-        else:
-            raise Exception(f"Unrecognized status: {status}")
-        self._event.set()
+        return parser.parse_args(argv)
+
+
+def _print_device_state(state):
+    outlet_state_1 = state.outlet_state_1
+    outlet_state_2 = state.outlet_state_2
+    print(f"Outlet 1: {OUTLET_STATE_STR.get(outlet_state_1, outlet_state_1)}")
+    print(f"Outlet 2: {OUTLET_STATE_STR.get(outlet_state_2, outlet_state_2)}")
+    print(f"Target temperature: {state.target_temperature:.1f}C")
+    print(f"Actual temperature: {state.actual_temperature:.1f}C")
+    print("Timer state: "
+          f"{TIMER_STATE_STR.get(state.timer_state, state.timer_state)}")
+    print(f"Remaining seconds: {state.remaining_seconds}")
+
+
+def _print_command_result(record):
+    if (isinstance(record, miramode.records.SuccessOrFailure) and
+            record.status != miramode.SUCCESS):
+        raise Exception(f"Unrecognized status: {record.status}")
+    print("The command completed successfully")
+
+
+def _record_to_dict(record):
+    return dict(kind=record.kind, **record._asdict())
+
+
+def _process_replay_capture_command(args):
+    if args.raw:
+        for timestamp, direction, data in capture.iter_capture(args.file):
+            print(json.dumps({
+                "time": timestamp,
+                "direction": ("in" if direction == capture.DIRECTION_IN
+                              else "out"),
+                "data": data.hex()}))
+        return
+
+    for timestamp, record in capture.replay(
+            args.file, realtime=args.realtime, speed=args.speed):
+        print(json.dumps(
+            {"time": timestamp, "record": _record_to_dict(record)}))
 
 
 def _process_list_devices_command(args):
@@ -238,95 +405,460 @@ def _process_list_devices_command(args):
         print(f"{name}: {address}")
 
 
-def _process_get_device_command(args):
-    with miramode.Connnection(
-            args.address, args.client_id, args.client_slot) as conn:
+def _process_get_device_command(args, conn):
+    state = conn.get_device_state(args.max_age, args.timeout)
+    _print_device_state(state)
 
-        event = threading.Event()
-        notifications = Notifications(event)
-        conn.subscribe(notifications)
 
-        conn.request_device_state()
-        event.wait()
-        event.clear()
+def _process_watch_device_command(args, conn):
+    def _print_state(state):
+        line = {"time": datetime.datetime.now(
+            datetime.timezone.utc).isoformat()}
+        line.update(state._asdict())
+        print(json.dumps(line), flush=True)
 
+    try:
+        conn.watch(_print_state, args.fast_interval, args.slow_interval)
+    except KeyboardInterrupt:
+        pass
 
-def _process_list_clients_command(args):
-    with miramode.Connnection(
-            args.address, args.client_id, args.client_slot) as conn:
 
-        event = threading.Event()
-        notifications = Notifications(event)
-        conn.subscribe(notifications)
+def _print_clients(clients):
+    for slot, client_name in clients:
+        print(f"{slot}: {client_name}")
+
 
-        conn.request_client_slots()
-        event.wait()
-        event.clear()
+def _print_presets(presets):
+    for preset in presets:
+        print(f"{preset.preset_slot}: {preset.preset_name}, "
+              f"{preset.target_temperature:.1f}C, "
+              f"{preset.duration_seconds}s, "
+              f"outlets: {preset.outlet_enabled}")
 
-        for slot in notifications.slots:
-            print(f"Requesting details for client slot: {slot}")
-            conn.request_client_details(slot)
-            event.wait()
-            event.clear()
 
+def _process_list_clients_command(args, conn):
+    if args.no_cache:
+        clients = conn.get_clients(args.window, args.timeout)
+    else:
+        with metadata.MetadataCache(args.cache_file) as cache:
+            clients = cache.get_clients(conn, args.window, args.timeout)
+    _print_clients(clients)
 
-def _process_pair_client_command(args):
-    with miramode.Connnection(args.address) as conn:
 
-        event = threading.Event()
-        notifications = Notifications(event, is_pairing=True)
-        conn.subscribe(notifications)
+def _process_list_presets_command(args, conn):
+    if args.no_cache:
+        presets = conn.get_presets(args.window, args.timeout)
+    else:
+        with metadata.MetadataCache(args.cache_file) as cache:
+            presets = cache.get_presets(conn, args.window, args.timeout)
+    _print_presets(presets)
+
 
-        new_client_id = args.client_id
-        if not new_client_id:
-            max_client_id = (1 << 16) - 1
-            new_client_id = random.randint(10000, max_client_id)
+def _process_cached_command(args):
+    # Returns True if the command was answered from the metadata cache,
+    # without connecting to the device
+    if (args.command not in (CMD_LIST_CLIENTS, CMD_LIST_PRESETS) or
+            args.no_cache or args.cache_max_age is None):
+        return False
 
-        print(f"Pairing new client id: {new_client_id}, "
-              f"name: {args.client_name}")
+    with metadata.MetadataCache(args.cache_file) as cache:
+        if args.command == CMD_LIST_CLIENTS:
+            clients = cache.get_cached_clients(
+                args.address, args.cache_max_age)
+            if clients is not None:
+                _print_clients(clients)
+                return True
+        else:
+            presets = cache.get_cached_presets(
+                args.address, args.cache_max_age)
+            if presets is not None:
+                _print_presets(presets)
+                return True
+    return False
 
-        conn.pair_client(new_client_id, args.client_name)
-        event.wait()
-        event.clear()
 
+def _process_pair_client_command(args, conn):
+    new_client_id = args.client_id
+    if not new_client_id:
+        max_client_id = (1 << 16) - 1
+        new_client_id = random.randint(10000, max_client_id)
 
-def _process_unpair_client_command(args):
-    with miramode.Connnection(
-            args.address, args.client_id, args.client_slot) as conn:
+    print(f"Pairing new client id: {new_client_id}, "
+          f"name: {args.client_name}")
 
-        event = threading.Event()
-        notifications = Notifications(event)
-        conn.subscribe(notifications)
+    response = conn.pair_client(new_client_id, args.client_name)
+    print(f"Assigned client slot: {response.result(args.timeout).status}")
 
-        conn.unpair_client(args.client_slot_to_unpair)
-        event.wait()
-        event.clear()
 
+def _process_unpair_client_command(args, conn):
+    response = conn.unpair_client(args.client_slot_to_unpair)
+    _print_command_result(response.result(args.timeout))
 
-def _process_control_outlets_command(args):
+
+def _process_control_outlets_command(args, conn):
+    response = conn.control_outlets(
+        args.outlet1, args.outlet2, args.temperature)
+    _print_command_result(response.result(args.timeout))
+
+
+def _process_start_preset_command(args, conn):
+    response = conn.start_preset(args.preset)
+    _print_command_result(response.result(args.timeout))
+
+
+CONNECTION_COMMANDS = {
+    CMD_GET_DEVICE_STATE: _process_get_device_command,
+    CMD_WATCH_DEVICE: _process_watch_device_command,
+    CMD_LIST_CLIENTS: _process_list_clients_command,
+    CMD_LIST_PRESETS: _process_list_presets_command,
+    CMD_PAIR_CLIENT: _process_pair_client_command,
+    CMD_UNPAIR_CLIENT: _process_unpair_client_command,
+    CMD_CONTROL_OUTLETS: _process_control_outlets_command,
+    CMD_START_PRESET: _process_start_preset_command,
+}
+
+
+# Long running commands streaming their output, always executed without the
+# daemon
+STREAMING_COMMANDS = {
+    CMD_WATCH_DEVICE,
+}
+
+
+def _get_client_data(args):
+    # When pairing, the client id argument is the id of the new client
+    if args.command == CMD_PAIR_CLIENT:
+        return None, None
+    return args.client_id, args.client_slot
+
+
+def _execute_connection_command(args, conn):
+    if args.capture:
+        conn.start_capture(args.capture)
+    try:
+        CONNECTION_COMMANDS[args.command](args, conn)
+    except miramode.CommandFailedError:
+        print("The command failed")
+        return 1
+    except miramode.ResponseTimeoutError:
+        print("The device did not respond in time")
+        return 1
+    finally:
+        if args.capture:
+            conn.stop_capture()
+    return 0
+
+
+def _run_command(args):
+    if args.command == CMD_LIST_DEVICES:
+        _process_list_devices_command(args)
+        return 0
+
+    client_id, client_slot = _get_client_data(args)
     with miramode.Connnection(
-            args.address, args.client_id, args.client_slot) as conn:
+            args.address, client_id, client_slot,
+            response_timeout=args.timeout) as conn:
+        return _execute_connection_command(args, conn)
+
+
+def _execute_daemon_command(argv, pool):
+    args = _parse_args(argv)
+    if not args:
+        return 0
 
-        event = threading.Event()
-        notifications = Notifications(event)
+    if args.command == CMD_LIST_DEVICES:
+        _process_list_devices_command(args)
+        return 0
+    if (args.command not in CONNECTION_COMMANDS or
+            args.command in STREAMING_COMMANDS):
+        print(f"Command not supported by the daemon: {args.command}")
+        return 2
+
+    client_id, client_slot = _get_client_data(args)
+    conn = pool.get(args.address, client_id, client_slot)
+    try:
+        exit_code = _execute_connection_command(args, conn)
+    except Exception:
+        # Do not reuse a connection in an unknown state
+        pool.discard(args.address)
+        raise
+    pool.release(args.address)
+    return exit_code
+
+
+def _is_batch_command(command):
+    return (command == BATCH_CMD_SLEEP or
+            (command in CONNECTION_COMMANDS and
+             command not in STREAMING_COMMANDS))
+
+
+def _parse_batch_line(line):
+    # Returns a (command, arguments, timeout) tuple, or None for blank lines
+    # and comments
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        entry = json.loads(line)
+        return (entry["command"], [str(a) for a in entry.get("args", [])],
+                entry.get("timeout"))
+    if line.startswith("["):
+        argv = [str(a) for a in json.loads(line)]
+    else:
+        argv = shlex.split(line)
+    if not argv:
+        return None
+    return argv[0], argv[1:], None
+
+
+def _get_connection_argv(args, command, command_args, timeout=None):
+    # The connection arguments are taken from the batch or shell command,
+    # the ones following them can override the timeout and the client, see
+    # _check_connection_args()
+    argv = [command, "-a", args.address,
+            "--timeout", str(timeout or args.timeout)]
+    if _add_client_args in COMMAND_PARSERS[command][1]:
+        argv += ["-c", str(args.client_id), "-s", str(args.client_slot)]
+    return argv + command_args
+
+
+def _check_connection_args(args, command_args):
+    # Batch and shell commands run on the connection opened for them, the
+    # options affecting the connection itself cannot be changed per command
+    defaults = argparse.ArgumentParser(add_help=False)
+    _add_address_args(defaults)
+    for name in ("capture", "socket", "no_daemon"):
+        if getattr(command_args, name) != defaults.get_default(name):
+            option = "--" + name.replace("_", "-")
+            raise ValueError(
+                f"{option} is not supported by the {args.command} commands, "
+                f"pass it to {args.command} instead")
+    if command_args.address.lower() != args.address.lower():
+        raise ValueError(
+            f"The {args.command} commands run on {args.address}, not on "
+            f"{command_args.address}")
+
+
+def _execute_batch_line(args, conn, command, command_args, timeout):
+    # Returns the exit code and the command output
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), \
+            contextlib.redirect_stderr(output):
+        try:
+            if command == BATCH_CMD_SLEEP:
+                time.sleep(float(command_args[0]))
+                return 0, output.getvalue()
+
+            command_args = _parse_args(
+                _get_connection_argv(args, command, command_args, timeout))
+            conn.set_client_data(*_get_client_data(command_args))
+            exit_code = _execute_connection_command(command_args, conn)
+        except SystemExit as ex:
+            # Raised by argparse for invalid arguments
+            exit_code = ex.code if isinstance(ex.code, int) else 1
+        except Exception as ex:
+            print(f"Error: {ex}")
+            exit_code = 1
+    return exit_code, output.getvalue()
+
+
+def _validate_batch_args(args, command, command_args, timeout):
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), \
+                contextlib.redirect_stderr(output):
+            command_args = _parse_args(
+                _get_connection_argv(args, command, command_args, timeout))
+    except SystemExit:
+        # Raised by argparse for invalid arguments, after printing the error
+        raise ValueError(output.getvalue().strip().splitlines()[-1])
+    _check_connection_args(args, command_args)
+
+
+def _process_batch_command(args):
+    if args.file == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.file) as f:
+            lines = f.read().splitlines()
+
+    # Validate the whole batch before connecting
+    commands = []
+    for line_number, line in enumerate(lines, 1):
+        try:
+            parsed = _parse_batch_line(line)
+            if parsed is None:
+                continue
+            command, command_args, timeout = parsed
+            if not _is_batch_command(command):
+                raise ValueError(f"not supported in a batch: {command}")
+            if command == BATCH_CMD_SLEEP:
+                float(command_args[0])
+            else:
+                _validate_batch_args(args, command, command_args, timeout)
+        except (ValueError, KeyError, TypeError, IndexError) as ex:
+            print(json.dumps({"line": line_number, "exit_code": 2,
+                              "output": f"Invalid command: {ex}\n"}))
+            return 2
+        commands.append((line_number, parsed))
+
+    failed = False
+    with miramode.Connnection(
+            args.address, args.client_id, args.client_slot,
+            response_timeout=args.timeout) as conn:
+        if args.capture:
+            conn.start_capture(args.capture)
+        try:
+            for line_number, (command, command_args, timeout) in commands:
+                started = time.monotonic()
+                exit_code, output = _execute_batch_line(
+                    args, conn, command, command_args, timeout)
+                print(json.dumps({
+                    "line": line_number,
+                    "command": command,
+                    "args": command_args,
+                    "exit_code": exit_code,
+                    "output": output,
+                    "elapsed": round(time.monotonic() - started, 6),
+                }), flush=True)
+                if exit_code:
+                    failed = True
+                    if not args.keep_going:
+                        break
+        finally:
+            if args.capture:
+                conn.stop_capture()
+    return 1 if failed else 0
+
+
+class _ShellNotifications(miramode.RecordNotifications):
+    def __init__(self, shell):
+        self._shell = shell
+
+    def record(self, record):
+        # The responses to the shell's own commands are printed by them
+        if not self._shell.busy:
+            self._shell.print_async(
+                f"Notification: {json.dumps(_record_to_dict(record))}")
+
+
+def _get_shell_commands():
+    # Maps the commands available in the shell to their options, omitting
+    # the connection ones
+    connection_options = set()
+    connection_parser = argparse.ArgumentParser(add_help=False)
+    _add_client_args(connection_parser)
+    for action in connection_parser._actions:
+        connection_options.update(action.option_strings)
+
+    commands = {}
+    for command in CONNECTION_COMMANDS:
+        parser = argparse.ArgumentParser(add_help=False)
+        for add_args in COMMAND_PARSERS[command][1]:
+            add_args(parser)
+        commands[command] = sorted(
+            option for action in parser._actions
+            for option in action.option_strings
+            if option.startswith("--") and option not in connection_options)
+    return commands
+
+
+def _execute_shell_command(args, conn, notifications, argv):
+    command = argv[0]
+    try:
+        command_args = _parse_args(
+            _get_connection_argv(args, command, argv[1:]))
+    except SystemExit:
+        # argparse already printed the usage or the error
+        return
+    try:
+        _check_connection_args(args, command_args)
+    except ValueError as ex:
+        print(f"Error: {ex}")
+        return
+
+    if not conn.connected and not conn.reconnecting:
+        print("Connecting...")
+        conn.connect()
+        # Print the notifications received before the next request as well
         conn.subscribe(notifications)
+    conn.set_client_data(*_get_client_data(command_args))
+    try:
+        _execute_connection_command(command_args, conn)
+    except Exception as ex:
+        print(f"Error: {ex}")
 
-        conn.control_outlets(args.outlet1, args.outlet2, args.temperature)
-        event.wait()
-        event.clear()
 
+def _process_shell_command(args):
+    # Imported here as readline is slow to import
+    from miramode import shell
 
-def _process_start_preset_command(args):
     with miramode.Connnection(
-            args.address, args.client_id, args.client_slot) as conn:
-
-        event = threading.Event()
-        notifications = Notifications(event)
+            args.address, args.client_id, args.client_slot,
+            response_timeout=args.timeout) as conn:
+        if args.capture:
+            conn.start_capture(args.capture)
+
+        mira_shell = shell.Shell(
+            _get_shell_commands(),
+            lambda argv: _execute_shell_command(
+                args, conn, notifications, argv),
+            history_path=shell.get_default_history_path())
+        notifications = _ShellNotifications(mira_shell)
         conn.subscribe(notifications)
+        try:
+            mira_shell.run(f"Connected to {args.address}, type help for "
+                           "the list of commands")
+        finally:
+            if args.capture:
+                conn.stop_capture()
+
+
+def _process_daemon_command(args):
+    if not daemon.is_supported():
+        raise Exception("The daemon requires Unix domain sockets support")
+
+    recorder = None
+    if args.metrics_port is not None:
+        recorder = metrics.MetricsRecorder()
+        metrics.serve_prometheus(
+            recorder, args.metrics_port, args.metrics_host)
+    daemon.serve(args.socket, _execute_daemon_command, args.idle_timeout,
+                 recorder)
 
-        conn.start_preset(args.preset)
-        event.wait()
-        event.clear()
+
+def _process_serve_command(args):
+    # Imported here as the server is only needed by this command
+    import asyncio
+    from miramode import server
+
+    try:
+        asyncio.run(server.serve(
+            args.devices, args.host, args.port, args.timeout,
+            args.min_command_interval))
+    except KeyboardInterrupt:
+        pass
+
+
+def _run_with_daemon(args):
+    # The daemon might have to connect to the device first
+    timeout = (getattr(args, "timeout", miramode.TIMEOUT) +
+               miramode.DEFAULT_CONNECT_DEADLINE + DAEMON_TIMEOUT_MARGIN)
+    try:
+        result = daemon.send_command(args.socket, sys.argv[1:], timeout)
+    except daemon.DaemonTimeoutError as ex:
+        # Not executed directly, the daemon might still send the command
+        print(ex)
+        sys.exit(1)
+    if result is None:
+        return False
+
+    exit_code, output = result
+    sys.stdout.write(output)
+    sys.stdout.flush()
+    if exit_code:
+        sys.exit(exit_code)
+    return True
 
 
 def _setup_logging(debug):
@@ -341,20 +873,21 @@ def main():
 
     _setup_logging(args.debug)
 
-    if args.command == CMD_LIST_DEVICES:
-        _process_list_devices_command(args)
-    elif args.command == CMD_GET_DEVICE_STATE:
-        _process_get_device_command(args)
-    elif args.command == CMD_LIST_CLIENTS:
-        _process_list_clients_command(args)
-    elif args.command == CMD_PAIR_CLIENT:
-        _process_pair_client_command(args)
-    elif args.command == CMD_UNPAIR_CLIENT:
-        _process_unpair_client_command(args)
-    elif args.command == CMD_CONTROL_OUTLETS:
-        _process_control_outlets_command(args)
-    elif args.command == CMD_START_PRESET:
-        _process_start_preset_command(args)
+    if args.command == CMD_DAEMON:
+        _process_daemon_command(args)
+    elif args.command == CMD_REPLAY_CAPTURE:
+        _process_replay_capture_command(args)
+    elif args.command == CMD_BATCH:
+        sys.exit(_process_batch_command(args))
+    elif args.command == CMD_SHELL:
+        _process_shell_command(args)
+    elif args.command == CMD_SERVE:
+        _process_serve_command(args)
+    elif _process_cached_command(args):
+        sys.exit(0)
+    elif (args.no_daemon or args.command in STREAMING_COMMANDS or
+            not _run_with_daemon(args)):
+        sys.exit(_run_command(args))
 
 
 if __name__ == '__main__':
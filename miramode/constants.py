@@ -0,0 +1,23 @@
+MAGIC_ID = 0x54d2ee63
+
+FAILURE = 0x80
+SUCCESS = 1
+
+TIMER_STOPPED = 0
+TIMER_RUNNING = 1
+TIMER_PAUSED = 3
+
+OUTLET_RUNNING = 0x64
+OUTLET_STOPPED = 0
+
+OPCODE_DEVICE_STATE = 0x07
+OPCODE_OUTLET_SETTINGS = 0x10
+OPCODE_PRESETS = 0x30
+OPCODE_TECHNICAL_INFO = 0x32
+OPCODE_DEVICE_SETTINGS = 0x3e
+OPCODE_NICKNAME = 0x44
+OPCODE_CLIENTS = 0x6b
+OPCODE_CONTROL_OUTLETS = 0x87
+OPCODE_START_PRESET = 0xb1
+OPCODE_PAIR_CLIENT = 0xeb
+OPCODE_UNPAIR_CLIENT = 0xeb
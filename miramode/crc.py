@@ -0,0 +1,45 @@
+CRC16_INIT = 0xFFFF
+CRC16_POLY = 0x1021
+
+
+def _make_table(poly):
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ poly) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+
+_CRC16_TABLE = _make_table(CRC16_POLY)
+
+
+def crc16(data, crc=CRC16_INIT):
+    # CRC-16/CCITT-FALSE. The state is the CRC value itself, so passing the
+    # result of a previous call as "crc" continues the computation.
+    table = _CRC16_TABLE
+    for b in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ b]
+    return crc
+
+
+class Crc16:
+    def __init__(self, data=None, crc=CRC16_INIT):
+        self._crc = crc
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        self._crc = crc16(data, self._crc)
+        return self
+
+    def copy(self):
+        return Crc16(crc=self._crc)
+
+    @property
+    def value(self):
+        return self._crc
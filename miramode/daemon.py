@@ -0,0 +1,200 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import miramode
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TIMEOUT = 300
+IDLE_CHECK_INTERVAL = 5
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+class DaemonTimeoutError(Exception):
+    pass
+
+
+def get_default_socket_path():
+    path = os.environ.get("MIRAMODE_SOCKET")
+    if path:
+        return path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        # tempfile is slow to import, only needed as a fallback
+        import tempfile
+
+        runtime_dir = tempfile.gettempdir()
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return os.path.join(runtime_dir, f"miramode-{uid}.sock")
+
+
+def is_supported():
+    return hasattr(socket, "AF_UNIX")
+
+
+class ConnectionPool:
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, metrics=None):
+        self._idle_timeout = idle_timeout
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._stopped = threading.Event()
+        self._reaper = None
+
+    def start(self):
+        self._reaper = threading.Thread(target=self._close_idle, daemon=True)
+        self._reaper.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            for conn, _ in self._connections.values():
+                conn.disconnect()
+            self._connections.clear()
+
+    def get(self, address, client_id=None, client_slot=None):
+        key = address.lower()
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry:
+                conn = entry[0]
+            else:
+                logger.info(f"Connecting to: {address}")
+                conn = miramode.Connnection(address, metrics=self._metrics)
+                conn.connect()
+            conn.set_client_data(client_id, client_slot)
+            self._connections[key] = (conn, time.monotonic())
+            return conn
+
+    def release(self, address):
+        key = address.lower()
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry:
+                self._connections[key] = (entry[0], time.monotonic())
+
+    def discard(self, address):
+        with self._lock:
+            entry = self._connections.pop(address.lower(), None)
+        if entry:
+            entry[0].disconnect()
+
+    def _close_idle(self):
+        while not self._stopped.wait(IDLE_CHECK_INTERVAL):
+            now = time.monotonic()
+            with self._lock:
+                idle = [key for key, (_, last_used) in
+                        self._connections.items()
+                        if now - last_used > self._idle_timeout]
+                for key in idle:
+                    logger.info(f"Closing idle connection: {key}")
+                    conn, _ = self._connections.pop(key)
+                    conn.disconnect()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_SIZE)
+        try:
+            request = json.loads(line)
+            argv = request["argv"]
+        except (ValueError, KeyError, TypeError):
+            self._send_response(2, "Invalid request\n")
+            return
+
+        output = io.StringIO()
+        exit_code = 0
+        # Commands print their results, so they need to run one at a time
+        with self.server.command_lock:
+            with contextlib.redirect_stdout(output):
+                try:
+                    exit_code = self.server.execute(argv, self.server.pool)
+                except SystemExit as ex:
+                    exit_code = ex.code if isinstance(ex.code, int) else 1
+                except Exception as ex:
+                    logger.exception("Command failed")
+                    print(f"Error: {ex}")
+                    exit_code = 1
+        self._send_response(exit_code or 0, output.getvalue())
+
+    def _send_response(self, exit_code, output):
+        response = {"exit_code": exit_code, "output": output}
+        self.wfile.write(json.dumps(response).encode("UTF-8") + b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, execute, pool):
+        self.execute = execute
+        self.pool = pool
+        self.command_lock = threading.Lock()
+        super().__init__(socket_path, _RequestHandler)
+
+
+def serve(socket_path, execute, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+          metrics=None):
+    if os.path.exists(socket_path):
+        if _is_listening(socket_path):
+            raise Exception(f"A daemon is already running on: {socket_path}")
+        os.unlink(socket_path)
+
+    pool = ConnectionPool(idle_timeout, metrics)
+    pool.start()
+    server = _Server(socket_path, execute, pool)
+    os.chmod(socket_path, 0o600)
+    # Make sure the socket gets removed when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info(f"Listening on: {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.stop()
+        os.unlink(socket_path)
+
+
+def _is_listening(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+def send_command(socket_path, argv, timeout=None):
+    # Returns None if no daemon is listening on socket_path. Raises
+    # DaemonTimeoutError if the daemon does not respond within timeout
+    # seconds, the command might have been executed in the meantime.
+    if not is_supported():
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return None
+
+        sock.settimeout(timeout)
+        try:
+            sock.sendall(
+                json.dumps({"argv": argv}).encode("UTF-8") + b"\n")
+            with sock.makefile("rb") as f:
+                response = json.loads(f.readline())
+        except socket.timeout:
+            raise DaemonTimeoutError(
+                f"The daemon did not respond within {timeout} seconds")
+        return response["exit_code"], response["output"]
+    finally:
+        sock.close()
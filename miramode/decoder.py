@@ -0,0 +1,125 @@
+import struct
+
+from miramode.constants import FAILURE, OUTLET_RUNNING, SUCCESS
+from miramode import records
+
+_SLOTS = struct.Struct(">H")
+_DEVICE_SETTINGS = struct.Struct(">xBBB")
+_DEVICE_STATE = struct.Struct(">BHHBBHB")
+_CONTROLS_OPERATED = struct.Struct(">BBHHBBHB")
+_OUTLET_SETTINGS = struct.Struct(">B3xBHHxB")
+_TECHNICAL_INFORMATION = struct.Struct(">xBxBxBxB7xB")
+_PRESET_DETAILS = struct.Struct(">BHxBB2x16s")
+
+_BITS = tuple(tuple(i for i in range(8) if value >> i & 1)
+              for value in range(256))
+_HIGH_BITS = tuple(tuple(i + 8 for i in bits) for bits in _BITS)
+
+
+def _bits_to_list(value):
+    return list(_BITS[value])
+
+
+def _decode_success_or_failure(client_slot, payload):
+    return records.SuccessOrFailure(client_slot, payload[0])
+
+
+def _decode_slots(client_slot, payload):
+    slot_bits, = _SLOTS.unpack(payload)
+    slots = list(_BITS[slot_bits & 0xFF] + _HIGH_BITS[slot_bits >> 8])
+    return records.Slots(client_slot, slots)
+
+
+def _decode_device_settings(client_slot, payload):
+    outlet_enabled, default_preset_slot, controller_senntings = (
+        _DEVICE_SETTINGS.unpack(payload))
+    return records.DeviceSettings(
+        client_slot, _bits_to_list(outlet_enabled), default_preset_slot,
+        _bits_to_list(controller_senntings))
+
+
+def _decode_device_state(client_slot, payload):
+    (timer_state, target_temperature, actual_temperature, outlet_state_1,
+     outlet_state_2, remaining_seconds,
+     succesful_update_command_counter) = _DEVICE_STATE.unpack(payload)
+    return records.DeviceState(
+        client_slot, timer_state, target_temperature / 10.0,
+        actual_temperature / 10.0, outlet_state_1 == OUTLET_RUNNING,
+        outlet_state_2 == OUTLET_RUNNING, remaining_seconds,
+        succesful_update_command_counter)
+
+
+def _decode_controls_operated(client_slot, payload):
+    (change_made, timer_state, target_temperature, actual_temperature,
+     outlet_state_1, outlet_state_2, remaining_seconds,
+     succesful_update_command_counter) = _CONTROLS_OPERATED.unpack(payload)
+    return records.ControlsOperated(
+        client_slot, change_made == SUCCESS, timer_state,
+        target_temperature / 10.0, actual_temperature / 10.0,
+        outlet_state_1 == OUTLET_RUNNING, outlet_state_2 == OUTLET_RUNNING,
+        remaining_seconds, succesful_update_command_counter)
+
+
+def _decode_outlet_settings(client_slot, payload):
+    (outlet_flag, min_duration_seconds, max_temperature, min_temperature,
+     succesful_update_command_counter) = _OUTLET_SETTINGS.unpack(payload)
+    return records.OutletSettings(
+        client_slot, outlet_flag, min_duration_seconds,
+        max_temperature / 10.0, min_temperature / 10.0,
+        succesful_update_command_counter)
+
+
+def _decode_11_bytes(client_slot, payload):
+    # Both controls operated and outlet settings are 11 bytes long, the
+    # first byte tells them apart
+    first = payload[0]
+    if first == SUCCESS or first == FAILURE:
+        return _decode_controls_operated(client_slot, payload)
+    if first in (0, 0x4, 0x8):
+        return _decode_outlet_settings(client_slot, payload)
+
+
+def _decode_16_bytes(client_slot, payload):
+    # Technical information starts with 0, a nickname with its first char
+    if payload[0] == 0:
+        return records.TechnicalInformation(
+            client_slot, *_TECHNICAL_INFORMATION.unpack(payload))
+    return records.Nickname(client_slot, str(payload, 'UTF-8'))
+
+
+def _decode_client_details(client_slot, payload):
+    return records.ClientDetails(client_slot, str(payload, 'UTF-8'))
+
+
+def _decode_preset_details(client_slot, payload):
+    (preset_slot, target_temperature, duration_seconds, outlet_enabled,
+     preset_name) = _PRESET_DETAILS.unpack(payload)
+    return records.PresetDetails(
+        client_slot, preset_slot, target_temperature / 10.0,
+        duration_seconds, _bits_to_list(outlet_enabled),
+        preset_name.decode('UTF-8'))
+
+
+# The payload length identifies the response type
+_DECODERS = [None] * 256
+_DECODERS[1] = _decode_success_or_failure
+_DECODERS[2] = _decode_slots
+_DECODERS[4] = _decode_device_settings
+_DECODERS[10] = _decode_device_state
+_DECODERS[11] = _decode_11_bytes
+_DECODERS[16] = _decode_16_bytes
+_DECODERS[20] = _decode_client_details
+_DECODERS[24] = _decode_preset_details
+
+
+def decode(client_slot, payload):
+    # Returns a miramode.records instance, or None if the payload is not
+    # recognized
+    decoder = _DECODERS[len(payload)] if len(payload) < 256 else None
+    if decoder is not None:
+        return decoder(client_slot, payload)
+
+
+def dispatch(notifications, record):
+    # Invokes the miramode.NotificationsBase method matching the record
+    getattr(notifications, record.kind)(*record)
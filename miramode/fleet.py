@@ -0,0 +1,116 @@
+import collections
+import concurrent.futures
+import logging
+
+import miramode
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class FleetResult(collections.namedtuple(
+        "FleetResult", ["address", "value", "error"])):
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class Fleet:
+    # Operates multiple devices concurrently. devices is an iterable of
+    # (address, client_id, client_slot) tuples. The bulk operations return
+    # a dict of FleetResult instances keyed by address.
+    def __init__(self, devices, max_workers=DEFAULT_MAX_WORKERS,
+                 timeout=None):
+        self._connections = {
+            address: miramode.Connnection(address, client_id, client_slot)
+            for address, client_id, client_slot in devices}
+        self._max_workers = max_workers
+        self._timeout = timeout
+
+    @property
+    def addresses(self):
+        return list(self._connections)
+
+    def get_connection(self, address):
+        return self._connections[address]
+
+    def connect(self):
+        # A single scan finds all the devices, the connections then get the
+        # peripherals from the scan cache
+        try:
+            miramode._get_peripherals(use_cache=False)
+        except Exception:
+            logger.exception("Shared scan failed")
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._max_workers,
+                thread_name_prefix="miramode-fleet") as executor:
+            futures = {
+                address: executor.submit(conn.connect)
+                for address, conn in self._connections.items()
+                if not conn.connected}
+            return {address: self._get_result(address, future)
+                    for address, future in futures.items()}
+
+    def disconnect(self):
+        for conn in self._connections.values():
+            conn.disconnect()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.disconnect()
+
+    def _get_result(self, address, future, timeout=None):
+        try:
+            return FleetResult(address, future.result(timeout), None)
+        except Exception as ex:
+            logger.debug(f"Operation failed on {address}: {ex}")
+            return FleetResult(address, None, ex)
+
+    def _request_all(self, send, addresses=None):
+        # All the requests are written before waiting for any response, so
+        # the whole operation takes about one round trip
+        results = {}
+        responses = {}
+        for address in addresses or self._connections:
+            conn = self._connections[address]
+            if not conn.connected:
+                results[address] = FleetResult(
+                    address, None, Exception("Not connected"))
+                continue
+            try:
+                responses[address] = send(address, conn)
+            except Exception as ex:
+                results[address] = FleetResult(address, None, ex)
+
+        for address, response in responses.items():
+            results[address] = self._get_result(
+                address, response, self._timeout)
+        return results
+
+    def state_all(self, addresses=None):
+        return self._request_all(
+            lambda address, conn: conn.request_device_state(), addresses)
+
+    def control_outlets_many(self, outlet1, outlet2, temperature,
+                             addresses=None):
+        return self._request_all(
+            lambda address, conn: conn.control_outlets(
+                outlet1, outlet2, temperature), addresses)
+
+    def start_preset_many(self, preset_slots, addresses=None):
+        # preset_slots is either a slot used for all the devices or a dict
+        # of slots keyed by address
+        if isinstance(preset_slots, dict):
+            addresses = addresses or list(preset_slots)
+            return self._request_all(
+                lambda address, conn: conn.start_preset(
+                    preset_slots[address]), addresses)
+        return self._request_all(
+            lambda address, conn: conn.start_preset(preset_slots), addresses)
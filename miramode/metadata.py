@@ -0,0 +1,272 @@
+import functools
+import json
+import os
+import threading
+import time
+
+import miramode
+from miramode import records
+
+CACHE_FILE_NAME = "metadata.sqlite3"
+
+# Records changing only when the device configuration changes, as reported
+# by the successful update command counter
+_COUNTER_KINDS = (
+    records.DeviceSettings.kind,
+    records.Nickname.kind,
+    records.OutletSettings.kind,
+    records.PresetDetails.kind,
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    address TEXT PRIMARY KEY,
+    update_counter INTEGER,
+    client_slots TEXT,
+    preset_slots TEXT,
+    validated REAL
+);
+CREATE TABLE IF NOT EXISTS records (
+    address TEXT,
+    kind TEXT,
+    key INTEGER,
+    value TEXT,
+    updated REAL,
+    PRIMARY KEY (address, kind, key)
+);
+"""
+
+
+def get_default_cache_path():
+    path = os.environ.get("MIRAMODE_CACHE")
+    if path:
+        return path
+    cache_dir = (os.environ.get("XDG_CACHE_HOME") or
+                 os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_dir, "miramode", CACHE_FILE_NAME)
+
+
+class MetadataCache:
+    # Stores the records that rarely change (clients, presets, nickname,
+    # settings and technical information) per device address. Cached records
+    # are dropped when the device reports different client or preset slots,
+    # or a different successful update command counter.
+    def __init__(self, path=None):
+        # Imported on first use, as it is slow to import
+        import sqlite3
+
+        if path is None:
+            path = get_default_cache_path()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)),
+                        exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.executescript(_SCHEMA)
+            columns = [row[1] for row in self._db.execute(
+                "PRAGMA table_info(devices)")]
+            # Added after the first release of the cache
+            if "validated" not in columns:
+                self._db.execute(
+                    "ALTER TABLE devices ADD COLUMN validated REAL")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _get_device(self, address, max_age=None):
+        row = self._db.execute(
+            "SELECT update_counter, client_slots, preset_slots, validated "
+            "FROM devices WHERE address = ?", (address,)).fetchone()
+        if row is None:
+            return None, None, None
+        update_counter, client_slots, preset_slots, validated = row
+        if max_age is not None and (
+                validated is None or time.time() - validated > max_age):
+            return None, None, None
+        return (update_counter,
+                None if client_slots is None else json.loads(client_slots),
+                None if preset_slots is None else json.loads(preset_slots))
+
+    def _delete_records(self, address, kinds):
+        self._db.execute(
+            "DELETE FROM records WHERE address = ? AND kind IN "
+            f"({','.join('?' * len(kinds))})", (address, *kinds))
+
+    def validate(self, address, update_counter=None, client_slots=None,
+                 preset_slots=None):
+        # Drops the records invalidated by the given device values, which
+        # are then stored for the next validation
+        address = address.lower()
+        with self._lock, self._db:
+            stored_counter, stored_clients, stored_presets = (
+                self._get_device(address))
+
+            if (update_counter is not None and
+                    update_counter != stored_counter):
+                self._delete_records(address, _COUNTER_KINDS)
+                stored_counter = update_counter
+            if client_slots is not None and client_slots != stored_clients:
+                self._delete_records(address, (records.ClientDetails.kind,))
+                stored_clients = client_slots
+            if preset_slots is not None and preset_slots != stored_presets:
+                self._delete_records(address, (records.PresetDetails.kind,))
+                stored_presets = preset_slots
+
+            self._db.execute(
+                "INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?)",
+                (address, stored_counter,
+                 None if stored_clients is None else json.dumps(
+                     stored_clients),
+                 None if stored_presets is None else json.dumps(
+                     stored_presets),
+                 time.time()))
+
+    def get_slots(self, address, max_age=None):
+        # Returns the last validated (client_slots, preset_slots), if
+        # validated within max_age seconds when set
+        with self._lock:
+            _, client_slots, preset_slots = self._get_device(
+                address.lower(), max_age)
+        return client_slots, preset_slots
+
+    def _get_cached_records(self, address, kind, slots):
+        if slots is None:
+            return None
+        cached = [self.get_record(address, kind, slot) for slot in slots]
+        if None in cached:
+            return None
+        return cached
+
+    def get_cached_clients(self, address, max_age):
+        # Like get_clients(), without contacting the device. Returns None
+        # unless all the clients are cached and were validated within
+        # max_age seconds.
+        slots, _ = self.get_slots(address, max_age)
+        details = self._get_cached_records(
+            address, records.ClientDetails.kind, slots)
+        if details is not None:
+            return [(slot, d.client_name) for slot, d in zip(slots, details)]
+
+    def get_cached_presets(self, address, max_age):
+        _, slots = self.get_slots(address, max_age)
+        return self._get_cached_records(
+            address, records.PresetDetails.kind, slots)
+
+    def get_record(self, address, kind, key=0):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM records WHERE address = ? AND kind = ? "
+                "AND key = ?", (address.lower(), kind, key)).fetchone()
+        if row is not None:
+            return records.RECORD_TYPES[kind](**json.loads(row[0]))
+
+    def put_record(self, address, record, key=0):
+        # key tells apart multiple records of the same kind, e.g. the slot
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)",
+                (address.lower(), record.kind, key,
+                 json.dumps(record._asdict()), time.time()))
+
+    def clear(self, address=None):
+        with self._lock, self._db:
+            if address is None:
+                self._db.execute("DELETE FROM records")
+                self._db.execute("DELETE FROM devices")
+            else:
+                self._db.execute("DELETE FROM records WHERE address = ?",
+                                 (address.lower(),))
+                self._db.execute("DELETE FROM devices WHERE address = ?",
+                                 (address.lower(),))
+
+    def _get_records(self, conn, request, kind, keys, window, timeout):
+        # Returns the records for the given keys, requesting the missing
+        # ones in a single pipeline
+        cached = {key: self.get_record(conn.address, kind, key)
+                  for key in keys}
+        missing = [key for key, record in cached.items() if record is None]
+        if missing:
+            fetched = conn.pipeline(
+                [functools.partial(request, key) for key in missing],
+                window, timeout)
+            for key, record in zip(missing, fetched):
+                self.put_record(conn.address, record, key)
+                cached[key] = record
+        return [cached[key] for key in keys]
+
+    def _validate_counter(self, conn, verify, max_age, timeout):
+        if verify:
+            state = conn.get_device_state(max_age, timeout)
+            self.validate(
+                conn.address,
+                update_counter=state.succesful_update_command_counter)
+
+    def get_clients(self, conn, window=miramode.DEFAULT_PIPELINE_WINDOW,
+                    timeout=None, verify=True):
+        # Like miramode.Connnection.get_clients(). With verify, the client
+        # slots are requested to validate the cache, otherwise the cached
+        # slots are trusted and a warm cache needs no request at all.
+        slots, _ = self.get_slots(conn.address)
+        if verify or slots is None:
+            slots = conn.request_client_slots().result(timeout).slots
+            self.validate(conn.address, client_slots=slots)
+        details = self._get_records(
+            conn, conn.request_client_details, records.ClientDetails.kind,
+            slots, window, timeout)
+        return [(slot, d.client_name) for slot, d in zip(slots, details)]
+
+    def get_presets(self, conn, window=miramode.DEFAULT_PIPELINE_WINDOW,
+                    timeout=None, verify=True,
+                    max_age=miramode.DEFAULT_STATE_MAX_AGE):
+        # Like miramode.Connnection.get_presets(), the update counter is
+        # taken from a device state not older than max_age seconds
+        self._validate_counter(conn, verify, max_age, timeout)
+        _, slots = self.get_slots(conn.address)
+        if verify or slots is None:
+            slots = conn.request_preset_slots().result(timeout).slots
+            self.validate(conn.address, preset_slots=slots)
+        return self._get_records(
+            conn, conn.request_preset_details, records.PresetDetails.kind,
+            slots, window, timeout)
+
+    def _get_single(self, conn, request, kind, verify, max_age, timeout):
+        if kind in _COUNTER_KINDS:
+            self._validate_counter(conn, verify, max_age, timeout)
+        record = self.get_record(conn.address, kind)
+        if record is None:
+            record = request().result(timeout)
+            self.put_record(conn.address, record)
+        return record
+
+    def get_nickname(self, conn, timeout=None, verify=True,
+                     max_age=miramode.DEFAULT_STATE_MAX_AGE):
+        return self._get_single(
+            conn, conn.request_nickname, records.Nickname.kind, verify,
+            max_age, timeout).nickname
+
+    def get_device_settings(self, conn, timeout=None, verify=True,
+                            max_age=miramode.DEFAULT_STATE_MAX_AGE):
+        return self._get_single(
+            conn, conn.request_device_settings, records.DeviceSettings.kind,
+            verify, max_age, timeout)
+
+    def get_outlet_settings(self, conn, timeout=None, verify=True,
+                            max_age=miramode.DEFAULT_STATE_MAX_AGE):
+        return self._get_single(
+            conn, conn.request_outlet_settings, records.OutletSettings.kind,
+            verify, max_age, timeout)
+
+    def get_technical_info(self, conn, timeout=None):
+        # Not affected by the update counter, use clear() after a firmware
+        # update
+        return self._get_single(
+            conn, conn.request_technical_info,
+            records.TechnicalInformation.kind, False, None, timeout)
@@ -0,0 +1,265 @@
+import bisect
+import collections
+import logging
+import threading
+
+from miramode.constants import (
+    OPCODE_CLIENTS, OPCODE_CONTROL_OUTLETS, OPCODE_DEVICE_SETTINGS,
+    OPCODE_DEVICE_STATE, OPCODE_NICKNAME, OPCODE_OUTLET_SETTINGS,
+    OPCODE_PAIR_CLIENT, OPCODE_PRESETS, OPCODE_START_PRESET,
+    OPCODE_TECHNICAL_INFO)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 9464
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+OPCODE_NAMES = {
+    OPCODE_DEVICE_STATE: "device_state",
+    OPCODE_OUTLET_SETTINGS: "outlet_settings",
+    OPCODE_PRESETS: "presets",
+    OPCODE_TECHNICAL_INFO: "technical_info",
+    OPCODE_DEVICE_SETTINGS: "device_settings",
+    OPCODE_NICKNAME: "nickname",
+    OPCODE_CLIENTS: "clients",
+    OPCODE_CONTROL_OUTLETS: "control_outlets",
+    OPCODE_START_PRESET: "start_preset",
+    # Pairing and unpairing share the same opcode
+    OPCODE_PAIR_CLIENT: "client_pairing",
+}
+
+
+class MetricsBase():
+    # Hooks invoked by miramode.Connnection when metrics are enabled, from
+    # the caller's and the BLE library's threads. Durations are in seconds.
+    def request_sent(self, address, opcode):
+        pass
+
+    def response_received(self, address, opcode, latency):
+        pass
+
+    def command_failed(self, address, opcode, latency):
+        pass
+
+    def response_timed_out(self, address, opcode):
+        pass
+
+    def notification_received(self, address, length):
+        pass
+
+    def packet_fragmented(self, address):
+        pass
+
+    def packet_dropped(self, address):
+        pass
+
+    def scan_completed(self, address, duration, found):
+        pass
+
+    def connect_completed(self, address, duration, succeeded):
+        pass
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Metric name: (type, help)
+_METRICS = {
+    "miramode_requests_total": (
+        "counter", "Requests sent to the device"),
+    "miramode_response_latency_seconds": (
+        "histogram", "Time between a request and its response"),
+    "miramode_command_failures_total": (
+        "counter", "Requests the device reported as failed"),
+    "miramode_response_timeouts_total": (
+        "counter", "Requests without a response within the timeout"),
+    "miramode_notifications_total": (
+        "counter", "BLE notifications received"),
+    "miramode_notification_bytes_total": (
+        "counter", "Bytes received in BLE notifications"),
+    "miramode_packets_fragmented_total": (
+        "counter", "Payloads split across multiple notifications"),
+    "miramode_packets_dropped_total": (
+        "counter", "Notifications discarded by the reassembly"),
+    "miramode_scan_duration_seconds": (
+        "histogram", "Time spent scanning for a device"),
+    "miramode_connect_duration_seconds": (
+        "histogram", "Time spent connecting to a device"),
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"'))
+        for name, value in labels)
+    return "{" + values + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRecorder(MetricsBase):
+    # Aggregates the metrics in memory, see render_prometheus()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(int)
+        self._histograms = {}
+
+    def _inc(self, name, labels, value=1):
+        with self._lock:
+            self._counters[(name, labels)] += value
+
+    def _observe(self, name, labels, value, buckets):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = Histogram(buckets)
+                self._histograms[(name, labels)] = histogram
+            histogram.observe(value)
+
+    @staticmethod
+    def _opcode_labels(address, opcode):
+        return (("address", address), ("opcode", f"{opcode:#04x}"),
+                ("command", OPCODE_NAMES.get(opcode, "unknown")))
+
+    def request_sent(self, address, opcode):
+        self._inc("miramode_requests_total",
+                  self._opcode_labels(address, opcode))
+
+    def response_received(self, address, opcode, latency):
+        self._observe("miramode_response_latency_seconds",
+                      self._opcode_labels(address, opcode), latency,
+                      LATENCY_BUCKETS)
+
+    def command_failed(self, address, opcode, latency):
+        self._inc("miramode_command_failures_total",
+                  self._opcode_labels(address, opcode))
+
+    def response_timed_out(self, address, opcode):
+        self._inc("miramode_response_timeouts_total",
+                  self._opcode_labels(address, opcode))
+
+    def notification_received(self, address, length):
+        labels = (("address", address),)
+        with self._lock:
+            self._counters[("miramode_notifications_total", labels)] += 1
+            self._counters[
+                ("miramode_notification_bytes_total", labels)] += length
+
+    def packet_fragmented(self, address):
+        self._inc("miramode_packets_fragmented_total",
+                  (("address", address),))
+
+    def packet_dropped(self, address):
+        self._inc("miramode_packets_dropped_total",
+                  (("address", address),))
+
+    def scan_completed(self, address, duration, found):
+        self._observe("miramode_scan_duration_seconds",
+                      (("address", address), ("found", str(found).lower())),
+                      duration, DURATION_BUCKETS)
+
+    def connect_completed(self, address, duration, succeeded):
+        self._observe("miramode_connect_duration_seconds",
+                      (("address", address),
+                       ("succeeded", str(succeeded).lower())),
+                      duration, DURATION_BUCKETS)
+
+    def get_counter(self, name, **labels):
+        # Sums the counter values matching the given labels
+        with self._lock:
+            return sum(value for (n, l), value in self._counters.items()
+                       if n == name and labels.items() <= dict(l).items())
+
+    def get_histogram(self, name, **labels):
+        # Returns a (count, sum) tuple for the series matching the labels
+        with self._lock:
+            matching = [h for (n, l), h in self._histograms.items()
+                        if n == name and labels.items() <= dict(l).items()]
+            return (sum(h.count for h in matching),
+                    sum(h.sum for h in matching))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render_prometheus(self):
+        # Returns the metrics in the Prometheus text exposition format
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count, h.buckets))
+                for key, h in self._histograms.items())
+
+        lines = []
+        for name, (metric_type, help) in _METRICS.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (n, labels), value in counters:
+                if n == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (n, labels), (counts, total, count, buckets) in histograms:
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(
+                        buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    bucket_labels = labels + (("le", _format_value(bound)),)
+                    lines.append(f"{name}_bucket"
+                                 f"{_format_labels(bucket_labels)} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} "
+                             f"{_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(recorder, port=DEFAULT_PORT, host="127.0.0.1"):
+    # Serves the metrics of a MetricsRecorder on http://host:port/metrics
+    # from a background thread. Returns the server, call shutdown() on it
+    # to stop serving.
+    import http.server
+
+    class _Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = recorder.render_prometheus().encode("UTF-8")
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name="miramode-metrics").start()
+    logger.info(f"Serving metrics on: http://{host}:{port}/metrics")
+    return server
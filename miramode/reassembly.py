@@ -0,0 +1,117 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+HEADER_LENGTH = 3
+MAX_PAYLOAD_LENGTH = 0xFF
+DEFAULT_STALE_TIMEOUT = 2.0
+
+
+class Reassembler:
+    # Rebuilds payloads split across any number of notifications. The first
+    # notification starts with a header: 0x40 + client slot, opcode and
+    # payload length, the following ones contain only payload data.
+    #
+    # The returned payloads are memoryview instances referencing either the
+    # notification or an internal buffer, they are valid only until the
+    # next call to feed().
+    def __init__(self, stale_timeout=DEFAULT_STALE_TIMEOUT):
+        self._stale_timeout = stale_timeout
+        self._buffer = bytearray(MAX_PAYLOAD_LENGTH)
+        self._view = memoryview(self._buffer)
+        self._client_slot = None
+        self._expected_length = 0
+        self._received_length = 0
+        self._started = None
+
+        self.completed = 0
+        self.fragmented = 0
+        self.short = 0
+        self.oversized = 0
+        self.stale = 0
+
+    @property
+    def stats(self):
+        return {
+            "completed": self.completed,
+            "fragmented": self.fragmented,
+            "short": self.short,
+            "oversized": self.oversized,
+            "stale": self.stale,
+            "dropped": self.short + self.oversized + self.stale,
+        }
+
+    @property
+    def in_progress(self):
+        return self._started is not None
+
+    def reset(self):
+        self._client_slot = None
+        self._expected_length = 0
+        self._received_length = 0
+        self._started = None
+
+    def feed(self, value):
+        # Returns a (client_slot, payload) tuple once a payload is complete,
+        # None otherwise
+        if self._started is not None:
+            if time.monotonic() - self._started <= self._stale_timeout:
+                return self._continue(value)
+            logger.warning(
+                "Dropping stale partial payload: "
+                f"{self._received_length}/{self._expected_length}")
+            self.stale += 1
+            self.reset()
+
+        if len(value) < HEADER_LENGTH:
+            logger.warning(
+                f"Packet length is too short, skipping: {len(value)}")
+            self.short += 1
+            return None
+
+        client_slot = value[0] - 0x40
+        payload_length = value[2]
+        data = memoryview(value)[HEADER_LENGTH:]
+
+        if len(data) == payload_length:
+            self.completed += 1
+            return client_slot, data
+
+        if len(data) > payload_length:
+            logger.warning(
+                "Inconsistent payload length, skipping: "
+                f"{payload_length}, {len(data)}")
+            self.oversized += 1
+            return None
+
+        self._view[:len(data)] = data
+        self._client_slot = client_slot
+        self._expected_length = payload_length
+        self._received_length = len(data)
+        self._started = time.monotonic()
+        self.fragmented += 1
+        return None
+
+    def _continue(self, value):
+        start = self._received_length
+        end = start + len(value)
+        if end > self._expected_length:
+            logger.warning(
+                "Inconsistent payload length, skipping: "
+                f"{self._expected_length}, {end}")
+            self.oversized += 1
+            self.reset()
+            # Usually the previous continuation was lost and this is the
+            # header of the next payload
+            return self.feed(value)
+
+        self._view[start:end] = value
+        self._received_length = end
+        if end < self._expected_length:
+            return None
+
+        client_slot = self._client_slot
+        self.reset()
+        self.completed += 1
+        return client_slot, self._view[:end]
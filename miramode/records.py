@@ -0,0 +1,87 @@
+import collections
+
+# Each record has the same fields as the arguments of the corresponding
+# NotificationsBase method, whose name is stored in "kind".
+
+
+class ClientDetails(collections.namedtuple(
+        "ClientDetails", ["client_slot", "client_name"])):
+    __slots__ = ()
+    kind = "client_details"
+
+
+class ControlsOperated(collections.namedtuple(
+        "ControlsOperated", [
+            "client_slot", "change_made", "timer_state",
+            "target_temperature", "actual_temperature", "outlet_state_1",
+            "outlet_state_2", "remaining_seconds",
+            "succesful_update_command_counter"])):
+    __slots__ = ()
+    kind = "controls_operated"
+
+
+class DeviceSettings(collections.namedtuple(
+        "DeviceSettings", [
+            "client_slot", "outlet_enabled", "default_preset_slot",
+            "controller_senntings"])):
+    __slots__ = ()
+    kind = "device_settings"
+
+
+class DeviceState(collections.namedtuple(
+        "DeviceState", [
+            "client_slot", "timer_state", "target_temperature",
+            "actual_temperature", "outlet_state_1", "outlet_state_2",
+            "remaining_seconds", "succesful_update_command_counter"])):
+    __slots__ = ()
+    kind = "device_state"
+
+
+class Nickname(collections.namedtuple(
+        "Nickname", ["client_slot", "nickname"])):
+    __slots__ = ()
+    kind = "nickname"
+
+
+class OutletSettings(collections.namedtuple(
+        "OutletSettings", [
+            "client_slot", "outlet_flag", "min_duration_seconds",
+            "max_temperature", "min_temperature",
+            "succesful_update_command_counter"])):
+    __slots__ = ()
+    kind = "outlet_settings"
+
+
+class PresetDetails(collections.namedtuple(
+        "PresetDetails", [
+            "client_slot", "preset_slot", "target_temperature",
+            "duration_seconds", "outlet_enabled", "preset_name"])):
+    __slots__ = ()
+    kind = "preset_details"
+
+
+class Slots(collections.namedtuple("Slots", ["client_slot", "slots"])):
+    __slots__ = ()
+    kind = "slots"
+
+
+class SuccessOrFailure(collections.namedtuple(
+        "SuccessOrFailure", ["client_slot", "status"])):
+    __slots__ = ()
+    kind = "success_or_failure"
+
+
+class TechnicalInformation(collections.namedtuple(
+        "TechnicalInformation", [
+            "client_slot", "valve_type", "valve_sw_version", "ui_type",
+            "ui_sw_version", "bt_sw_version"])):
+    __slots__ = ()
+    kind = "technical_information"
+
+
+RECORD_TYPES = {
+    record_type.kind: record_type for record_type in [
+        ClientDetails, ControlsOperated, DeviceSettings, DeviceState,
+        Nickname, OutletSettings, PresetDetails, Slots, SuccessOrFailure,
+        TechnicalInformation]
+}
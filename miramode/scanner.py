@@ -0,0 +1,168 @@
+import collections
+import logging
+import threading
+import time
+
+import miramode
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EXPIRY = 30
+MAINTENANCE_INTERVAL = 1
+
+
+class DeviceRecord(collections.namedtuple(
+        "DeviceRecord", [
+            "identifier", "address", "rssi", "last_seen",
+            "manufacturer_data"])):
+    __slots__ = ()
+
+
+class ScannerListenerBase():
+    def appeared(self, device):
+        pass
+
+    def updated(self, device):
+        pass
+
+    def disappeared(self, device):
+        pass
+
+
+class BackgroundScanner:
+    # Scans continuously, keeping a registry of the devices whose name
+    # contains name_filter. While running, device discovery in miramode uses
+    # the registry instead of scanning again. Devices not seen for longer
+    # than expiry seconds are removed.
+    def __init__(self, expiry=DEFAULT_EXPIRY, name_filter="Mira"):
+        self._expiry = expiry
+        self._name_filter = name_filter
+        self._condition = threading.Condition()
+        self._devices = {}
+        self._peripherals = {}
+        self._listeners = []
+        self._adapter = None
+        self._stopped = threading.Event()
+        self._maintenance = None
+
+    def add_listener(self, listener):
+        # listener is a ScannerListenerBase, invoked on the scanner threads
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    @property
+    def running(self):
+        return self._adapter is not None
+
+    def start(self):
+        if self.running:
+            return
+        self._stopped.clear()
+        # Wait for any discovery scan in progress, which would otherwise
+        # stop this scan and reset its callbacks when done
+        with miramode._scan_lock:
+            self._adapter = miramode._get_adapter()
+            self._adapter.set_callback_on_scan_found(self._on_scan_result)
+            self._adapter.set_callback_on_scan_updated(self._on_scan_result)
+            self._adapter.scan_start()
+            miramode._set_active_scanner(self)
+
+        self._maintenance = threading.Thread(
+            target=self._maintain, daemon=True,
+            name="miramode-scanner")
+        self._maintenance.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stopped.set()
+        self._maintenance.join()
+        with miramode._scan_lock:
+            miramode._set_active_scanner(None)
+            adapter = self._adapter
+            self._adapter = None
+            adapter.scan_stop()
+            adapter.set_callback_on_scan_found(lambda peripheral: None)
+            adapter.set_callback_on_scan_updated(lambda peripheral: None)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def get_devices(self):
+        with self._condition:
+            return list(self._devices.values())
+
+    def get_device(self, address):
+        with self._condition:
+            return self._devices.get(address.lower())
+
+    def get_peripheral(self, address):
+        with self._condition:
+            return self._peripherals.get(address.lower())
+
+    def get_peripherals(self):
+        with self._condition:
+            return list(self._peripherals.values())
+
+    def wait_for(self, address, timeout):
+        # Returns the peripheral as soon as it is advertised, or None
+        key = address.lower()
+        with self._condition:
+            self._condition.wait_for(
+                lambda: key in self._peripherals, timeout)
+            return self._peripherals.get(key)
+
+    def _on_scan_result(self, peripheral):
+        try:
+            identifier = peripheral.identifier()
+            if self._name_filter and self._name_filter not in identifier:
+                return
+
+            device = DeviceRecord(
+                identifier, peripheral.address(), peripheral.rssi(),
+                time.monotonic(), peripheral.manufacturer_data())
+        except Exception:
+            logger.exception("Cannot read the scan result")
+            return
+
+        key = device.address.lower()
+        with self._condition:
+            is_new = key not in self._devices
+            self._devices[key] = device
+            self._peripherals[key] = peripheral
+            self._condition.notify_all()
+        miramode._peripheral_cache.add(peripheral)
+
+        for listener in list(self._listeners):
+            if is_new:
+                listener.appeared(device)
+            else:
+                listener.updated(device)
+
+    def _maintain(self):
+        while not self._stopped.wait(MAINTENANCE_INTERVAL):
+            now = time.monotonic()
+            with self._condition:
+                expired = [d for d in self._devices.values()
+                           if now - d.last_seen > self._expiry]
+                for device in expired:
+                    key = device.address.lower()
+                    del self._devices[key]
+                    del self._peripherals[key]
+
+            for device in expired:
+                for listener in list(self._listeners):
+                    listener.disappeared(device)
+
+            # Some platforms end the scan on their own
+            try:
+                if not self._adapter.scan_is_active():
+                    self._adapter.scan_start()
+            except Exception:
+                logger.exception("Cannot restart the scan")
@@ -0,0 +1,138 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_INTERVAL = 0.5
+
+
+class _OutletCommand:
+    def __init__(self, outlet1, outlet2, temperature):
+        self.outlet1 = outlet1
+        self.outlet2 = outlet2
+        self.temperature = temperature
+        self.futures = []
+
+    @property
+    def is_off(self):
+        return not self.outlet1 and not self.outlet2
+
+
+class OutletScheduler:
+    # Sends the control_outlets commands of a miramode.Connnection one at a
+    # time, at least min_interval seconds apart, waiting for each response
+    # before the next write. A command still waiting to be sent is replaced
+    # by a newer one, so that only the latest desired state reaches the
+    # device. Commands turning both outlets off are never replaced.
+    def __init__(self, conn, min_interval=DEFAULT_MIN_INTERVAL):
+        self._conn = conn
+        self._min_interval = min_interval
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._last_write = None
+        self._stopped = False
+        self._worker = None
+
+        self.submitted = 0
+        self.written = 0
+        self.coalesced = 0
+
+    @property
+    def stats(self):
+        with self._condition:
+            return {
+                "submitted": self.submitted,
+                "written": self.written,
+                "coalesced": self.coalesced,
+                "queued": len(self._queue),
+            }
+
+    def control_outlets(self, outlet1, outlet2, temperature):
+        # Returns a concurrent.futures.Future resolved with the response to
+        # the write that carried this command, or the newer one replacing it
+        future = concurrent.futures.Future()
+        command = _OutletCommand(outlet1, outlet2, temperature)
+        with self._condition:
+            if self._stopped:
+                raise Exception("The scheduler is closed")
+            self.submitted += 1
+            if self._queue and not self._queue[-1].is_off:
+                # The pending command did not reach the device yet
+                command.futures = self._queue.pop().futures
+                self.coalesced += 1
+            command.futures.append(future)
+            self._queue.append(command)
+
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, daemon=True,
+                    name=f"miramode-scheduler-{self._conn.address}")
+                self._worker.start()
+            self._condition.notify()
+        return future
+
+    def close(self):
+        # Pending commands are still sent before the worker stops
+        with self._condition:
+            self._stopped = True
+            worker = self._worker
+            self._condition.notify()
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _next_command(self):
+        with self._condition:
+            while True:
+                if self._queue:
+                    delay = 0
+                    if self._last_write is not None:
+                        delay = (self._last_write + self._min_interval -
+                                 time.monotonic())
+                    if delay <= 0:
+                        return self._queue.popleft()
+                    # Newer commands can still replace the pending one
+                    self._condition.wait(delay)
+                elif self._stopped:
+                    return None
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            command = self._next_command()
+            if command is None:
+                return
+
+            try:
+                response = self._conn.control_outlets(
+                    command.outlet1, command.outlet2, command.temperature)
+                with self._condition:
+                    self._last_write = time.monotonic()
+                    self.written += 1
+                record = response.result()
+            except Exception as ex:
+                logger.debug(f"Outlet command failed: {ex}")
+                self._resolve(command, exception=ex)
+            else:
+                self._resolve(command, record)
+
+    @staticmethod
+    def _resolve(command, record=None, exception=None):
+        for future in command.futures:
+            try:
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(record)
+            except concurrent.futures.InvalidStateError:
+                # Cancelled by the caller, e.g. asyncio.wait_for()
+                pass
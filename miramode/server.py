@@ -0,0 +1,423 @@
+import asyncio
+import json
+import logging
+import urllib.parse
+
+import miramode
+from miramode import aio
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_TIMEOUT = 10
+HEADERS_TIMEOUT = 10
+EVENTS_KEEPALIVE_INTERVAL = 15
+EVENTS_QUEUE_SIZE = 100
+MAX_HEADERS = 100
+MAX_BODY_SIZE = 64 * 1024
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _record_to_dict(record):
+    return dict(kind=record.kind, **record._asdict())
+
+
+class _Device:
+    # Executes the commands sent to a device one at a time, in the order
+    # they were submitted. With min_command_interval, consecutive outlet
+    # commands are handed to the outlet scheduler together, so that it can
+    # coalesce them, and the next command waits for all of them.
+    def __init__(self, address, client_id, client_slot, timeout,
+                 min_command_interval):
+        self.address = address
+        # Give up connecting within the request timeout, so that the requests
+        # fail as unavailable rather than timing out
+        self.conn = aio.AsyncConnection(
+            address, client_id, client_slot, timeout,
+            reconnect_policy=miramode.ReconnectPolicy(deadline=timeout),
+            min_command_interval=min_command_interval)
+        self._coalesce_outlets = min_command_interval is not None
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    @property
+    def connected(self):
+        return self.conn.connection.connected
+
+    def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        await self.conn.close()
+
+    async def submit(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((func, args, future))
+        return await future
+
+    async def control_outlets(self, outlet1, outlet2, temperature):
+        return await self.submit(
+            self.conn.control_outlets, outlet1, outlet2, temperature)
+
+    def _is_coalescable(self, func):
+        return self._coalesce_outlets and func == self.conn.control_outlets
+
+    async def _ensure_connected(self):
+        conn = self.conn.connection
+        if not conn.connected and not conn.reconnecting:
+            logger.info(f"Connecting to: {self.address}")
+            await self.conn.connect()
+
+    async def _run(self):
+        item = None
+        while True:
+            if item is None:
+                item = await self._queue.get()
+            func, args, future = item
+            item = None
+
+            commands = [(func, args, future)]
+            if self._is_coalescable(func):
+                while not self._queue.empty():
+                    next_item = self._queue.get_nowait()
+                    if not self._is_coalescable(next_item[0]):
+                        # Executed once the outlet commands complete
+                        item = next_item
+                        break
+                    commands.append(next_item)
+            # Skip the HTTP requests that timed out while queued
+            commands = [c for c in commands if not c[2].done()]
+            if not commands:
+                continue
+
+            try:
+                await self._ensure_connected()
+            except Exception as ex:
+                for _, _, future in commands:
+                    _set_future(future, exception=ex)
+                continue
+
+            # The tasks start in order, handing the commands over to the
+            # outlet scheduler in the same order
+            tasks = [asyncio.ensure_future(func(*args))
+                     for func, args, _ in commands]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for (_, _, future), result in zip(commands, results):
+                if isinstance(result, Exception):
+                    _set_future(future, exception=result)
+                else:
+                    _set_future(future, result)
+
+
+def _set_future(future, result=None, exception=None):
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class BridgeServer:
+    # Exposes the devices over HTTP as JSON endpoints:
+    #
+    # GET  /devices
+    # GET  /devices/<address>
+    # GET  /devices/<address>/state[?max_age=<seconds>]
+    # GET  /devices/<address>/clients
+    # GET  /devices/<address>/presets
+    # POST /devices/<address>/outlets {"outlet1": true, "outlet2": false,
+    #                                  "temperature": 38.5}
+    # POST /devices/<address>/preset {"preset": 0}
+    # GET  /events, /devices/<address>/events
+    #
+    # The events endpoints stream the notifications of all the devices, or
+    # of a single one, as server-sent events.
+    # With min_command_interval, outlet commands arriving faster than the
+    # device can follow, e.g. from a slider, are coalesced, see
+    # miramode.scheduler.OutletScheduler.
+    def __init__(self, devices, timeout=DEFAULT_TIMEOUT,
+                 min_command_interval=None):
+        # devices is a list of (address, client_id, client_slot) tuples
+        self._devices = {
+            address.lower(): _Device(address, client_id, client_slot,
+                                     timeout, min_command_interval)
+            for address, client_id, client_slot in devices}
+        self._timeout = timeout
+        self._subscribers = set()
+        self._connect_tasks = set()
+        self._server = None
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        for device in self._devices.values():
+            device.conn.add_listener(
+                lambda record, address=device.address: self._publish(
+                    address, record))
+            device.start()
+        # Connect in the background, failed connections are retried by the
+        # first command
+        for device in self._devices.values():
+            # The event loop keeps only weak references to the tasks
+            task = asyncio.create_task(self._connect(device))
+            self._connect_tasks.add(task)
+            task.add_done_callback(self._connect_tasks.discard)
+
+        self._server = await asyncio.start_server(
+            self._handle_client, host, port)
+        logger.info(f"Listening on: http://{host}:{port}")
+        return self._server
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in list(self._connect_tasks):
+            task.cancel()
+        for device in self._devices.values():
+            await device.stop()
+
+    async def _connect(self, device):
+        try:
+            await device.submit(lambda: asyncio.sleep(0))
+        except Exception as ex:
+            logger.warning(f"Cannot connect to {device.address}: {ex}")
+
+    def _publish(self, address, record):
+        event = {"address": address, "record": _record_to_dict(record)}
+        for device_filter, queue in list(self._subscribers):
+            if device_filter is not None and device_filter != address.lower():
+                continue
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                logger.warning("Slow events client, dropping an event")
+
+    def _get_device(self, address):
+        device = self._devices.get(address.lower())
+        if device is None:
+            raise HttpError(404, f"Unknown device: {address}")
+        return device
+
+    async def _execute(self, device, command):
+        # command is a coroutine, usually a device.submit() call
+        try:
+            return await asyncio.wait_for(command, self._timeout)
+        except asyncio.TimeoutError:
+            if not device.connected:
+                raise HttpError(
+                    503, f"Cannot connect to the device: {device.address}")
+            raise HttpError(504, "The device did not respond in time")
+        except miramode.ResponseTimeoutError:
+            raise HttpError(504, "The device did not respond in time")
+        except miramode.CommandFailedError:
+            raise HttpError(502, "The command failed")
+        except (miramode.DeviceNotFoundError,
+                miramode.ConnectFailedError) as ex:
+            raise HttpError(503, str(ex))
+
+    async def _route(self, method, parts, params, body):
+        if parts in ([], ["devices"]):
+            self._check_method(method, "GET")
+            return [{"address": d.address, "connected": d.connected}
+                    for d in self._devices.values()]
+
+        if parts[0] != "devices" or len(parts) > 3:
+            raise HttpError(404, "Not found")
+        device = self._get_device(parts[1])
+        action = parts[2] if len(parts) == 3 else None
+
+        if action is None:
+            self._check_method(method, "GET")
+            return {"address": device.address, "connected": device.connected}
+
+        if action == "state":
+            self._check_method(method, "GET")
+            max_age = float(params.get("max_age", ["0"])[0])
+            state = await self._execute(
+                device, device.submit(device.conn.get_device_state, max_age))
+            return _record_to_dict(state)
+
+        if action == "clients":
+            self._check_method(method, "GET")
+            clients = await self._execute(
+                device, device.submit(device.conn.get_clients))
+            return [{"slot": slot, "name": name} for slot, name in clients]
+
+        if action == "presets":
+            self._check_method(method, "GET")
+            presets = await self._execute(
+                device, device.submit(device.conn.get_presets))
+            return [_record_to_dict(preset) for preset in presets]
+
+        if action == "outlets":
+            self._check_method(method, "POST")
+            request = self._parse_body(body)
+            record = await self._execute(device, device.control_outlets(
+                bool(request.get("outlet1", False)),
+                bool(request.get("outlet2", False)),
+                float(request["temperature"])))
+            return _record_to_dict(record)
+
+        if action == "preset":
+            self._check_method(method, "POST")
+            request = self._parse_body(body)
+            record = await self._execute(device, device.submit(
+                device.conn.start_preset, int(request["preset"])))
+            return _record_to_dict(record)
+
+        raise HttpError(404, "Not found")
+
+    @staticmethod
+    def _check_method(method, allowed):
+        if method != allowed:
+            raise HttpError(405, f"Method not allowed: {method}")
+
+    @staticmethod
+    def _parse_body(body):
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError as ex:
+            raise HttpError(400, f"Invalid JSON: {ex}")
+        if not isinstance(request, dict):
+            raise HttpError(400, "A JSON object is required")
+        return request
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "Invalid request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise HttpError(400, "Too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    async def _handle_client(self, reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(
+                    self._read_request(reader), HEADERS_TIMEOUT)
+                if request is None:
+                    return
+                method, target, headers = request
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_SIZE:
+                    raise HttpError(413, "Request body too large")
+                body = await reader.readexactly(length) if length else b""
+
+                url = urllib.parse.urlsplit(target)
+                parts = [urllib.parse.unquote(p)
+                         for p in url.path.split("/") if p]
+                params = urllib.parse.parse_qs(url.query)
+
+                if parts and parts[-1] == "events":
+                    self._check_method(method, "GET")
+                    if parts == ["events"]:
+                        address = None
+                    elif len(parts) == 3 and parts[0] == "devices":
+                        address = self._get_device(parts[1]).address.lower()
+                    else:
+                        raise HttpError(404, "Not found")
+                    await self._stream_events(writer, address)
+                    return
+
+                status, payload = 200, await self._route(
+                    method, parts, params, body)
+            except HttpError as ex:
+                status, payload = ex.status, {"error": str(ex)}
+            except (ValueError, KeyError, TypeError) as ex:
+                status, payload = 400, {"error": f"Invalid request: {ex}"}
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    ConnectionError):
+                # Slow, incomplete or vanished clients get no response
+                return
+            except Exception as ex:
+                logger.exception("Request failed")
+                status, payload = 500, {"error": str(ex)}
+            await self._send_response(writer, status, payload)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _send_response(self, writer, status, payload):
+        body = json.dumps(payload).encode("UTF-8")
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+    async def _stream_events(self, writer, address):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n")
+        await writer.drain()
+
+        subscriber = (address, asyncio.Queue(EVENTS_QUEUE_SIZE))
+        self._subscribers.add(subscriber)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscriber[1].get(), EVENTS_KEEPALIVE_INTERVAL)
+                    writer.write(
+                        f"event: {event['record']['kind']}\n"
+                        f"data: {json.dumps(event)}\n\n".encode("UTF-8"))
+                except asyncio.TimeoutError:
+                    # Comments keep the connection alive and detect clients
+                    # that went away
+                    writer.write(b": keepalive\n\n")
+                await writer.drain()
+        finally:
+            self._subscribers.discard(subscriber)
+
+
+async def serve(devices, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                timeout=DEFAULT_TIMEOUT, min_command_interval=None):
+    # Runs the server until cancelled
+    bridge = BridgeServer(devices, timeout, min_command_interval)
+    server = await bridge.start(host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await bridge.close()
@@ -0,0 +1,133 @@
+import cmd
+import logging
+import os
+import shlex
+import sys
+
+try:
+    import readline
+except ImportError:
+    # Not available on every platform, history and completion are disabled
+    readline = None
+
+logger = logging.getLogger(__name__)
+
+HISTORY_LENGTH = 1000
+HISTORY_FILE_NAME = "history"
+
+
+def get_default_history_path():
+    state_dir = (os.environ.get("XDG_STATE_HOME") or
+                 os.path.join(os.path.expanduser("~"), ".local", "state"))
+    return os.path.join(state_dir, "miramode", HISTORY_FILE_NAME)
+
+
+class Shell(cmd.Cmd):
+    # Reads commands interactively, passing them to execute(argv).
+    # commands maps each command name to the options offered by the tab
+    # completion.
+    def __init__(self, commands, execute, prompt="miramode> ",
+                 history_path=None):
+        super().__init__()
+        self.prompt = prompt
+        self.busy = False
+        self._commands = commands
+        self._execute = execute
+        self._history_path = history_path
+
+    def preloop(self):
+        if readline is None:
+            return
+        # Options start with dashes, complete them as a whole
+        readline.set_completer_delims(" \t\n")
+        if not self._history_path:
+            return
+        readline.set_history_length(HISTORY_LENGTH)
+        try:
+            readline.read_history_file(self._history_path)
+        except OSError:
+            pass
+
+    def postloop(self):
+        if readline is None or not self._history_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._history_path), exist_ok=True)
+            readline.write_history_file(self._history_path)
+        except OSError:
+            logger.exception(
+                f"Cannot save the history file: {self._history_path}")
+
+    def run(self, intro=None):
+        if intro:
+            print(intro)
+        while True:
+            try:
+                self.cmdloop()
+                return
+            except KeyboardInterrupt:
+                # Discard the current line, like most shells
+                print("^C")
+
+    def print_async(self, message):
+        # Prints a message while a command might be being typed, then
+        # restores the prompt and the line typed so far
+        line = readline.get_line_buffer() if readline is not None else ""
+        sys.stdout.write(f"\r\033[K{message}\n")
+        if not self.busy:
+            sys.stdout.write(self.prompt + line)
+        sys.stdout.flush()
+
+    def emptyline(self):
+        # Do not repeat the last command
+        pass
+
+    def default(self, line):
+        try:
+            argv = shlex.split(line)
+        except ValueError as ex:
+            print(f"Invalid command: {ex}")
+            return
+        if argv[0] not in self._commands:
+            print(f"Unknown command: {argv[0]}, type help for the list of "
+                  "commands")
+            return
+
+        self.busy = True
+        try:
+            self._execute(argv)
+        except KeyboardInterrupt:
+            print("^C")
+        finally:
+            self.busy = False
+
+    def do_help(self, arg):
+        if arg in self._commands:
+            self._execute([arg, "-h"])
+            return
+        print("Commands:")
+        for command in sorted(self._commands):
+            print(f"  {command}")
+        print("\nType help <command> for the command's arguments, exit to "
+              "quit")
+
+    def do_exit(self, arg):
+        return True
+
+    do_quit = do_exit
+
+    def do_EOF(self, arg):
+        print()
+        return True
+
+    def completenames(self, text, *ignored):
+        names = list(self._commands) + ["help", "exit", "quit"]
+        return [name for name in names if name.startswith(text)]
+
+    def completedefault(self, text, line, begidx, endidx):
+        command = line.split()[0]
+        return [option for option in self._commands.get(command, [])
+                if option.startswith(text)]
+
+    def complete_help(self, text, line, begidx, endidx):
+        return [name for name in self._commands if name.startswith(text)]
@@ -0,0 +1,473 @@
+import logging
+import queue
+import random
+import struct
+import threading
+import time
+
+import miramode
+from miramode.constants import (
+    FAILURE, MAGIC_ID, OPCODE_CLIENTS, OPCODE_CONTROL_OUTLETS,
+    OPCODE_DEVICE_SETTINGS, OPCODE_DEVICE_STATE, OPCODE_NICKNAME,
+    OPCODE_OUTLET_SETTINGS, OPCODE_PAIR_CLIENT, OPCODE_PRESETS,
+    OPCODE_START_PRESET, OPCODE_TECHNICAL_INFO, OPCODE_UNPAIR_CLIENT,
+    OUTLET_RUNNING, OUTLET_STOPPED, SUCCESS, TIMER_PAUSED, TIMER_RUNNING)
+from miramode import transport
+
+logger = logging.getLogger(__name__)
+
+SERVICE_UUID = "bccb0001-ca66-11e5-88a4-0002a5d5c51b"
+DEVICE_INFO_SERVICE_UUID = "0000180a-0000-1000-8000-00805f9b34fb"
+
+DEFAULT_MTU = 23
+AMBIENT_TEMPERATURE = 20.0
+MAX_SLOTS = 16
+
+_DEVICE_STATE = struct.Struct(">BHHBBHB")
+_CONTROLS_OPERATED = struct.Struct(">BBHHBBHB")
+_OUTLET_SETTINGS = struct.Struct(">B3xBHHxB")
+_PRESET_DETAILS = struct.Struct(">BHxBB2x16s")
+
+
+def _to_mira_temperature(celsius):
+    return int(round(celsius * 10))
+
+
+def _slot_bits(slots):
+    bits = 0
+    for slot in slots:
+        bits |= 1 << slot
+    return bits
+
+
+def _pad(value, length):
+    data = value.encode("UTF-8")[:length]
+    return data + bytes(length - len(data))
+
+
+class _Characteristic:
+    def __init__(self, uuid):
+        self._uuid = uuid
+
+    def uuid(self):
+        return self._uuid
+
+
+class _Service:
+    def __init__(self, uuid, characteristics):
+        self._uuid = uuid
+        self._characteristics = [_Characteristic(c) for c in characteristics]
+
+    def uuid(self):
+        return self._uuid
+
+    def characteristics(self):
+        return self._characteristics
+
+
+class SimulatedMiraDevice:
+    # Implements the subset of the simplepyble.Peripheral interface used by
+    # miramode, emulating the Mira Mode BLE protocol
+    def __init__(self, address, identifier="Mira Simulated", latency=0.0,
+                 packet_loss=0.0, mtu=DEFAULT_MTU, rssi=-60, seed=None):
+        self._address = address
+        self._identifier = identifier
+        self.latency = latency
+        self.packet_loss = packet_loss
+        self._mtu = mtu
+        self._rssi = rssi
+        self._random = random.Random(seed)
+
+        # Number of upcoming connection attempts that will fail
+        self.failing_connections = 0
+
+        self._lock = threading.Lock()
+        self._connected = False
+        self._notify_callback = None
+        self._on_disconnected = None
+        self._write_buffer = bytearray()
+        self._queue = queue.Queue()
+        self._worker = None
+
+        self.clients = {}
+        self.presets = {}
+        self.nickname = "Shower"
+        self.pairing_enabled = True
+        self.outlets_enabled = [0, 1]
+        self.default_preset_slot = 0
+        self.timer_state = TIMER_PAUSED
+        self.target_temperature = 38.0
+        self.outlet_state_1 = False
+        self.outlet_state_2 = False
+        self.remaining_seconds = 0
+        self.update_counter = 0
+        self.min_duration_seconds = 60
+        self.max_temperature = 45.0
+        self.min_temperature = 25.0
+        self.technical_info = (1, 2, 3, 4, 5)
+
+        self.writes = 0
+        self.notifications = 0
+        self.dropped = 0
+        self.crc_errors = 0
+
+    def add_client(self, client_id, client_name, client_slot=None):
+        if client_slot is None:
+            client_slot = self._get_free_slot(self.clients)
+        self.clients[client_slot] = (client_id, client_name)
+        return client_slot
+
+    def add_preset(self, preset_slot, preset_name, target_temperature=38.0,
+                   duration_seconds=60, outlet_enabled=(0,)):
+        if not 0 <= duration_seconds <= 0xFF:
+            raise ValueError("The preset duration must fit in a byte")
+        self.presets[preset_slot] = (
+            preset_name, target_temperature, duration_seconds,
+            list(outlet_enabled))
+
+    def _get_free_slot(self, slots):
+        for slot in range(MAX_SLOTS):
+            if slot not in slots:
+                return slot
+        return None
+
+    def address(self):
+        return self._address
+
+    def identifier(self):
+        return self._identifier
+
+    def rssi(self):
+        return self._rssi
+
+    def manufacturer_data(self):
+        return {}
+
+    def mtu(self):
+        return self._mtu
+
+    def is_connectable(self):
+        return True
+
+    def is_connected(self):
+        return self._connected
+
+    def connect(self):
+        with self._lock:
+            if self.failing_connections > 0:
+                self.failing_connections -= 1
+                raise Exception("Connection failed")
+            self._connected = True
+            self._write_buffer = bytearray()
+            # A single worker delivers the notifications in order
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._deliver_notifications, daemon=True)
+                self._worker.start()
+
+    def disconnect(self):
+        with self._lock:
+            was_connected = self._connected
+            self._connected = False
+            self._notify_callback = None
+        if was_connected and self._on_disconnected:
+            self._on_disconnected()
+
+    def simulate_link_loss(self):
+        self.disconnect()
+
+    def set_callback_on_connected(self, callback):
+        pass
+
+    def set_callback_on_disconnected(self, callback):
+        self._on_disconnected = callback
+
+    def services(self):
+        return [
+            _Service(DEVICE_INFO_SERVICE_UUID, [
+                miramode.UUID_DEVICE_NAME, miramode.UUID_MANUFACTURER,
+                miramode.UUID_MODEL_NUMBER]),
+            _Service(SERVICE_UUID, [miramode.UUID_WRITE, miramode.UUID_READ]),
+        ]
+
+    def read(self, service, characteristic):
+        self._check_connected()
+        values = {
+            miramode.UUID_DEVICE_NAME: self._identifier,
+            miramode.UUID_MANUFACTURER: "Kohler Mira Ltd",
+            miramode.UUID_MODEL_NUMBER: "Simulated",
+        }
+        return values[characteristic].encode("UTF-8")
+
+    def notify(self, service, characteristic, callback):
+        self._check_connected()
+        self._notify_callback = callback
+
+    def unsubscribe(self, service, characteristic):
+        self._notify_callback = None
+
+    def write_request(self, service, characteristic, data):
+        self.write_command(service, characteristic, data)
+
+    def write_command(self, service, characteristic, data):
+        self._check_connected()
+        with self._lock:
+            self.writes += 1
+            self._write_buffer.extend(data)
+            frames = self._extract_frames()
+        for frame in frames:
+            self._handle_frame(frame)
+
+    def _check_connected(self):
+        if not self._connected:
+            raise Exception("Peripheral not connected")
+
+    def _extract_frames(self):
+        # A frame is made of the client slot, the opcode, the payload length,
+        # the payload and the CRC, possibly split across multiple writes
+        frames = []
+        buffer = self._write_buffer
+        while len(buffer) >= 3:
+            frame_length = 3 + buffer[2] + 2
+            if len(buffer) < frame_length:
+                break
+            frames.append(bytes(buffer[:frame_length]))
+            del buffer[:frame_length]
+        return frames
+
+    def _handle_frame(self, frame):
+        client_slot = frame[0]
+        opcode = frame[1]
+        args = frame[3:-2]
+
+        is_pairing = opcode == OPCODE_PAIR_CLIENT and len(args) == 24
+        if is_pairing:
+            client_id = MAGIC_ID
+        elif client_slot in self.clients:
+            client_id = self.clients[client_slot][0]
+        else:
+            client_id = None
+
+        if client_id is None or (miramode._get_payload_with_crc(
+                frame[:-2], client_id) != frame):
+            self.crc_errors += 1
+            self._send(client_slot, opcode, bytes([FAILURE]))
+            return
+
+        with self._lock:
+            response = self._process(client_slot, opcode, args, is_pairing)
+        if response is not None:
+            self._send(client_slot, opcode, response)
+
+    def _process(self, client_slot, opcode, args, is_pairing):
+        if opcode == OPCODE_DEVICE_STATE:
+            return self._encode_state()
+
+        elif opcode == OPCODE_CLIENTS and args == b"\x00":
+            return struct.pack(">H", _slot_bits(self.clients))
+
+        elif opcode == OPCODE_CLIENTS and len(args) == 1:
+            client = self.clients.get(args[0] - 0x10)
+            if client is None:
+                return bytes([FAILURE])
+            return _pad(client[1], 20)
+
+        elif opcode == OPCODE_PRESETS and args == b"\x80":
+            return struct.pack(">H", _slot_bits(self.presets))
+
+        elif opcode == OPCODE_PRESETS and len(args) == 1:
+            preset_slot = args[0] - 0x40
+            preset = self.presets.get(preset_slot)
+            if preset is None:
+                return bytes([FAILURE])
+            name, temperature, duration, outlets = preset
+            return _PRESET_DETAILS.pack(
+                preset_slot, _to_mira_temperature(temperature), duration,
+                _slot_bits(outlets), _pad(name, 16))
+
+        elif opcode == OPCODE_DEVICE_SETTINGS:
+            return bytes([0, _slot_bits(self.outlets_enabled),
+                          self.default_preset_slot, 0])
+
+        elif opcode == OPCODE_NICKNAME:
+            return _pad(self.nickname, 16)
+
+        elif opcode == OPCODE_OUTLET_SETTINGS:
+            return _OUTLET_SETTINGS.pack(
+                0, self.min_duration_seconds,
+                _to_mira_temperature(self.max_temperature),
+                _to_mira_temperature(self.min_temperature),
+                self.update_counter)
+
+        elif opcode == OPCODE_TECHNICAL_INFO:
+            valve_type, valve_sw, ui_type, ui_sw, bt_sw = self.technical_info
+            return bytes([0, valve_type, 0, valve_sw, 0, ui_type, 0, ui_sw] +
+                         [0] * 7 + [bt_sw])
+
+        elif opcode == OPCODE_CONTROL_OUTLETS and len(args) == 5:
+            self.timer_state = args[0]
+            self.target_temperature = struct.unpack(">H", args[1:3])[0] / 10
+            self.outlet_state_1 = args[3] == OUTLET_RUNNING
+            self.outlet_state_2 = args[4] == OUTLET_RUNNING
+            self.remaining_seconds = 0
+            return self._encode_controls_operated()
+
+        elif opcode == OPCODE_START_PRESET and len(args) == 1:
+            preset = self.presets.get(args[0])
+            if preset is None:
+                return bytes([FAILURE])
+            _, temperature, duration, outlets = preset
+            self.timer_state = TIMER_RUNNING
+            self.target_temperature = temperature
+            self.outlet_state_1 = 0 in outlets
+            self.outlet_state_2 = 1 in outlets
+            self.remaining_seconds = duration
+            return self._encode_controls_operated()
+
+        elif is_pairing:
+            client_slot = self._get_free_slot(self.clients)
+            if not self.pairing_enabled or client_slot is None:
+                return bytes([FAILURE])
+            client_id = struct.unpack(">I", args[:4])[0]
+            name = args[4:].rstrip(b"\x00").decode("UTF-8")
+            self.clients[client_slot] = (client_id, name)
+            return bytes([client_slot])
+
+        elif opcode == OPCODE_UNPAIR_CLIENT and len(args) == 1:
+            if self.clients.pop(args[0], None) is None:
+                return bytes([FAILURE])
+            return bytes([SUCCESS])
+
+        logger.debug(f"Unsupported opcode: {opcode:#04x}, args: {args}")
+        return bytes([FAILURE])
+
+    def _actual_temperature(self):
+        if self.outlet_state_1 or self.outlet_state_2:
+            return self.target_temperature
+        return AMBIENT_TEMPERATURE
+
+    def _encode_state(self):
+        return _DEVICE_STATE.pack(
+            self.timer_state, _to_mira_temperature(self.target_temperature),
+            _to_mira_temperature(self._actual_temperature()),
+            OUTLET_RUNNING if self.outlet_state_1 else OUTLET_STOPPED,
+            OUTLET_RUNNING if self.outlet_state_2 else OUTLET_STOPPED,
+            self.remaining_seconds, self.update_counter)
+
+    def _encode_controls_operated(self):
+        self.update_counter = (self.update_counter + 1) & 0xFF
+        return _CONTROLS_OPERATED.pack(
+            SUCCESS, self.timer_state,
+            _to_mira_temperature(self.target_temperature),
+            _to_mira_temperature(self._actual_temperature()),
+            OUTLET_RUNNING if self.outlet_state_1 else OUTLET_STOPPED,
+            OUTLET_RUNNING if self.outlet_state_2 else OUTLET_STOPPED,
+            self.remaining_seconds, self.update_counter)
+
+    def _send(self, client_slot, opcode, payload):
+        packet = bytes([(0x40 + client_slot) & 0xFF, opcode,
+                        len(payload)]) + payload
+        chunk_size = self._mtu - 3
+        deliver_at = time.monotonic() + self.latency
+        for i in range(0, len(packet), chunk_size):
+            self._queue.put((deliver_at, packet[i:i + chunk_size]))
+
+    def _deliver_notifications(self):
+        while True:
+            deliver_at, data = self._queue.get()
+            delay = deliver_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            if self.packet_loss and self._random.random() < self.packet_loss:
+                self.dropped += 1
+                continue
+
+            callback = self._notify_callback
+            if callback is not None:
+                self.notifications += 1
+                callback(data)
+
+
+class SimulatedAdapter:
+    # Implements the subset of the simplepyble.Adapter interface used by
+    # miramode. While scanning, the devices advertise every
+    # advertising_interval seconds.
+    def __init__(self, devices, scan_delay=0.0, advertising_interval=1.0):
+        self._devices = devices
+        self._scan_delay = scan_delay
+        self._advertising_interval = advertising_interval
+        self._on_scan_found = None
+        self._on_scan_updated = None
+        self._scan_stopped = None
+
+    def identifier(self):
+        return "simulated"
+
+    def address(self):
+        return "00:00:00:00:00:00"
+
+    def set_callback_on_scan_found(self, callback):
+        self._on_scan_found = callback
+
+    def set_callback_on_scan_updated(self, callback):
+        self._on_scan_updated = callback
+
+    def set_callback_on_scan_start(self, callback):
+        pass
+
+    def set_callback_on_scan_stop(self, callback):
+        pass
+
+    def scan_for(self, timeout_ms):
+        time.sleep(min(self._scan_delay, timeout_ms / 1000))
+
+    def scan_start(self):
+        self.scan_stop()
+        stopped = threading.Event()
+        self._scan_stopped = stopped
+
+        def _advertise():
+            seen = set()
+            delay = self._scan_delay
+            while not stopped.wait(delay):
+                for device in list(self._devices):
+                    if device.address() in seen:
+                        callback = self._on_scan_updated
+                    else:
+                        seen.add(device.address())
+                        callback = self._on_scan_found
+                    if callback is not None and not stopped.is_set():
+                        callback(device)
+                delay = self._advertising_interval
+
+        threading.Thread(target=_advertise, daemon=True).start()
+
+    def scan_stop(self):
+        if self._scan_stopped is not None:
+            self._scan_stopped.set()
+            self._scan_stopped = None
+
+    def scan_is_active(self):
+        return self._scan_stopped is not None
+
+    def scan_get_results(self):
+        return list(self._devices)
+
+
+class SimulatedBackend(transport.BackendBase):
+    def __init__(self, devices=None, scan_delay=0.0,
+                 advertising_interval=1.0):
+        self.devices = list(devices or [])
+        self._adapter = SimulatedAdapter(
+            self.devices, scan_delay, advertising_interval)
+
+    def add_device(self, device):
+        self.devices.append(device)
+        return device
+
+    def remove_device(self, device):
+        self.devices.remove(device)
+
+    def get_adapter(self):
+        return self._adapter
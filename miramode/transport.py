@@ -0,0 +1,18 @@
+class BackendBase:
+    # A backend provides the BLE adapter used for scanning, returning
+    # objects with the same interface as simplepyble.Adapter and
+    # simplepyble.Peripheral
+    def get_adapter(self):
+        raise NotImplementedError()
+
+
+class SimplepybleBackend(BackendBase):
+    def get_adapter(self):
+        # Imported on first use, as loading the extension is slow and not
+        # needed by users of the protocol codec only
+        import simplepyble
+
+        adapters = simplepyble.Adapter.get_adapters()
+        if not adapters:
+            raise Exception("No BLE adapter found")
+        return adapters[0]